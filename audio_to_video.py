@@ -1,23 +1,76 @@
-import moviepy.editor as mp
 import os
 import logging
+import subprocess
 from pathlib import Path
 
-def audio_to_video(audio_file, output_file, duration=None):
+VIDEO_SIZE = (1280, 720)
+
+def ffmpeg_executable():
+    # moviepy ships its own ffmpeg through imageio-ffmpeg; fall back to whatever is on PATH
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return "ffmpeg"
+
+def audio_to_video(audio_file, output_file, duration=None, image_file=None, still=True, chapters_file=None):
+    if not still:
+        return audio_to_video_moviepy(audio_file, output_file, duration)
     try:
         # Ensure the paths are strings
         audio_file = str(audio_file)
         output_file = str(output_file)
-        
+        width, height = VIDEO_SIZE
+        fps = 1
+
+        # One still frame per second is all a static picture needs; the encoder barely works after the first frame
+        command = [ffmpeg_executable(), "-y", "-hide_banner", "-loglevel", "error"]
+        if image_file:
+            command += ["-loop", "1", "-framerate", str(fps), "-i", str(image_file)]
+        else:
+            # Create a plain black background
+            command += ["-f", "lavfi", "-i", f"color=c=black:s={width}x{height}:r={fps}"]
+        command += [
+            "-i", audio_file,
+        ]
+        if chapters_file:
+            # ffmetadata written next to the audio by text_to_audio; players and YouTube read the MP4 chapters
+            command += ["-f", "ffmetadata", "-i", str(chapters_file), "-map_chapters", "2"]
+        command += [
+            "-map", "0:v", "-map", "1:a",
+            "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,format=yuv420p",
+            "-c:v", "libx264", "-tune", "stillimage", "-preset", "veryfast", "-r", str(fps),
+            # The MP3 stream goes into the MP4 untouched
+            "-c:a", "copy",
+            "-shortest", "-movflags", "+faststart",
+        ]
+        if duration is not None:
+            command += ["-t", str(duration)]
+        command.append(output_file)
+
+        subprocess.run(command, check=True, capture_output=True, text=True)
+        logging.info(f"Video saved to {output_file}")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"An error occurred while converting audio to video: {e.stderr.strip()}")
+    except Exception as e:
+        logging.error(f"An error occurred while converting audio to video: {e}")
+
+def audio_to_video_moviepy(audio_file, output_file, duration=None):
+    import moviepy.editor as mp
+    try:
+        # Ensure the paths are strings
+        audio_file = str(audio_file)
+        output_file = str(output_file)
+
         # Load audio file
         audio = mp.AudioFileClip(audio_file)
-        
+
         # Set duration if not provided
         if duration is None:
             duration = audio.duration
 
         # Create a plain black background
-        image = mp.ColorClip(size=(1280, 720), color=(0, 0, 0), duration=duration)
+        image = mp.ColorClip(size=VIDEO_SIZE, color=(0, 0, 0), duration=duration)
 
         # Set audio to the video clip
         video = image.set_audio(audio)
@@ -0,0 +1,180 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from job_queue import JobQueue, worker_name
+
+# Runs a night's worth of stories from a JSONL file: one line per story,
+#   {"topic": "...", "world_details": "...", "audience": "all", "options": {"total_token_limit": 10000}}
+# The lines go into a JobQueue (SQLite) and a pool of worker processes takes jobs from it. Each worker runs one
+# story at a time through the usual stage graph, so the API-bound stages of one story overlap with the CPU-bound
+# audio stitching and video encoding of another without sharing a GIL.
+
+# story_stages options a job may set
+JOB_OPTIONS = ("stream_audio", "total_token_limit", "max_tokens_per_call")
+
+def load_jobs_file(jobs_path):
+    jobs = []
+    with open(jobs_path, "r", encoding="utf-8") as jobs_file:
+        for line_number, line in enumerate(jobs_file, 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append(parse_job(json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f"{jobs_path} line {line_number}: {e}")
+    return jobs
+
+def parse_job(job):
+    # A job spec as it goes into the queue, from a JSONL line or a POST to the daemon
+    if not isinstance(job, dict) or not isinstance(job.get("topic"), str) or not job["topic"].strip():
+        raise ValueError('a job needs a "topic" string')
+    world_details = job.get("world_details", "")
+    if isinstance(world_details, dict):
+        # Same format as the config file, "title": "World Description"
+        world_details = world_details.get(job["topic"], "")
+    options = job.get("options") or {}
+    unknown = set(options) - set(JOB_OPTIONS)
+    if unknown:
+        raise ValueError(f"unknown options {sorted(unknown)}, expected some of {list(JOB_OPTIONS)}")
+    return {"topic": job["topic"], "world_details": world_details, "audience": job.get("audience", "all"), "options": options}
+
+def default_client_factory(recorder):
+    from cli import make_client
+    return make_client(recorder)
+
+def run_job(client, recorder, job, stage_limiter=None, timings=None, tts_cache_dir=None, tts_requests_per_minute=None):
+    # One story through the whole stage graph; returns the output paths. A shared StageLimiter caps stages
+    # across concurrent jobs, and timings fills in with each stage as it finishes
+    from pipeline import run_stages
+    from story_creation_main import story_stages
+
+    spec = job["spec"]
+    topic = spec["topic"]
+    # A job that ran before (failed, released at shutdown or abandoned by a dead worker) picks up from its run
+    # manifest instead of starting over
+    stages = story_stages(client, None, topic, {topic: spec["world_details"]}, intended_audience=spec["audience"], resume=job.get("resume", False), tts_cache_dir=tts_cache_dir,
+                          tts_requests_per_minute=tts_requests_per_minute,
+                          **{name: value for name, value in spec["options"].items() if name in JOB_OPTIONS})
+    if stage_limiter is not None:
+        stages = stage_limiter.limit(stages)
+    timings = {} if timings is None else timings
+    try:
+        results = run_stages(stages, label=topic, timings=timings)
+    finally:
+        for name, timing in timings.items():
+            recorder.record_stage(topic, name, timing.duration, timing.status)
+    outputs = {name: str(results[name]) for name in ("story", "clean", "audio", "video") if results.get(name)}
+    outputs["images"] = [str(path) for path in results.get("images") or []]
+    return outputs
+
+def worker_main(db_path, worker_index, metrics_dir=".", retry_delay=60, heartbeat_seconds=30, client_factory=None, tts_cache_dir=None, tts_requests_per_minute=None):
+    # Entry point of each worker process: claims jobs until none are left to run
+    from metrics import MetricsRecorder
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    job_queue = JobQueue(db_path)
+    recorder = MetricsRecorder()
+    client = (client_factory or default_client_factory)(recorder)
+    worker = worker_name()
+    current_job = {}
+    stop = threading.Event()
+
+    def beat():
+        # Keeps the claim alive while a long story runs, so requeue_abandoned leaves it alone
+        while not stop.wait(heartbeat_seconds):
+            if current_job:
+                job_queue.heartbeat(current_job["id"])
+
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+        while True:
+            job = job_queue.claim(worker)
+            if job is None:
+                next_available = job_queue.next_available()
+                if next_available is None:
+                    break
+                # Only jobs waiting out a retry delay are left
+                time.sleep(min(max(next_available - time.time(), 0.1), heartbeat_seconds))
+                continue
+            current_job.update(job)
+            topic = job["topic"]
+            logging.info(f"Worker {worker_index} started '{topic}' (attempt {job['attempts']} of {job['max_attempts']})")
+            try:
+                outputs = run_job(client, recorder, job, tts_cache_dir=tts_cache_dir, tts_requests_per_minute=tts_requests_per_minute)
+            except Exception as e:
+                status = job_queue.fail(job["id"], e, retry_delay)
+                logging.error(f"Job '{topic}' failed: {e}; {status}")
+            else:
+                job_queue.complete(job["id"], outputs, cost=recorder.total_cost(story=topic))
+                logging.info(f"Job '{topic}' done, video at {outputs.get('video')}")
+            current_job.clear()
+    except KeyboardInterrupt:
+        if current_job:
+            job_queue.release(current_job["id"])
+            logging.warning(f"Worker {worker_index} stopped, '{current_job['topic']}' is back in the queue")
+    finally:
+        stop.set()
+        os.makedirs(metrics_dir, exist_ok=True)
+        recorder.write_json(os.path.join(metrics_dir, f"metrics_worker_{worker_index}.json"))
+
+def run_batch(db_path, jobs_path=None, workers=2, max_attempts=3, retry_delay=60, metrics_dir=".", client_factory=None, tts_cache_dir=None, tts_requests_per_minute=None):
+    # Safe to run again on the same database at any time: already queued jobs are kept, abandoned ones requeued
+    job_queue = JobQueue(db_path)
+    if jobs_path:
+        job_queue.add_jobs(load_jobs_file(jobs_path), max_attempts=max_attempts)
+    job_queue.requeue_abandoned()
+
+    start_time = time.time()
+    # Spawned rather than forked, so each worker starts with its own connection pool and no copied locks
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker_main, name=f"worker-{index}", args=(str(db_path), index, metrics_dir, retry_delay),
+                                 kwargs={"client_factory": client_factory, "tts_cache_dir": tts_cache_dir, "tts_requests_per_minute": tts_requests_per_minute})
+                 for index in range(1, workers + 1)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers got the same Ctrl-C and are putting their jobs back; wait for that before exiting
+        for process in processes:
+            process.join()
+    summary = batch_summary(job_queue, since=start_time)
+    log_batch_summary(summary)
+    return summary
+
+def batch_summary(job_queue, since=None):
+    # Stories/hour over this run's wall clock (since) or over the whole queue's history
+    jobs = job_queue.jobs()
+    finished = [job for job in jobs if job["status"] == "done" and (since is None or job["finished_at"] >= since)]
+    if since is None:
+        since = min((job["started_at"] for job in finished), default=time.time())
+    elapsed = max(max((job["finished_at"] for job in finished), default=since) - since, 1e-9)
+    return {
+        "counts": job_queue.counts(),
+        "finished": len(finished),
+        "elapsed_seconds": round(elapsed, 1),
+        "stories_per_hour": round(len(finished) * 3600 / elapsed, 2) if finished else 0.0,
+        "mean_job_seconds": round(sum(job["duration"] for job in finished) / len(finished), 1) if finished else 0.0,
+        "retries": sum(max(job["attempts"] - 1, 0) for job in jobs),
+        "cost": round(sum(job["cost"] or 0 for job in finished), 4),
+        "failed": {job["topic"]: job["last_error"] for job in jobs if job["status"] == "failed"},
+    }
+
+def log_batch_summary(summary):
+    counts = summary["counts"]
+    logging.info(f"Batch: {counts['done']} done, {counts['failed']} failed, {counts['queued']} queued, {counts['running']} running")
+    logging.info(f"Finished {summary['finished']} stories in {summary['elapsed_seconds'] / 60:.1f} minutes: {summary['stories_per_hour']} stories/hour, "
+                 f"{summary['mean_job_seconds']:.0f} seconds per story, {summary['retries']} retries, ${summary['cost']:.2f}")
+    for topic, error in summary["failed"].items():
+        logging.info(f"  failed: {topic}: {error}")
+
+def log_job_status(job_queue):
+    for job in job_queue.jobs():
+        outputs = job["outputs"] or {}
+        detail = outputs.get("video") or job["last_error"] or ""
+        logging.info(f"{job['id']:>4} {job['status']:<8} attempts {job['attempts']}/{job['max_attempts']}  {job['topic']}  {detail}")
@@ -0,0 +1,362 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mp3_frames
+
+# Rough benchmarks for the slow stages of the pipeline, run with: python benchmarks.py <benchmark> [options]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers ffmpeg processes started by pydub/moviepy
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+def run_in_fresh_process(target, *args, timeout=None):
+    # Each run gets its own interpreter so peak RSS belongs to that run alone
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_child, args=(results, target, args))
+    process.start()
+    return wait_for_child(process, results, getattr(target, "__name__", "benchmark"), timeout)
+
+def _child(results, target, args):
+    def timed():
+        start_time = time.perf_counter()
+        target(*args)
+        return time.perf_counter() - start_time, peak_rss_mb()
+
+    put_outcome(results, timed)
+
+def put_outcome(results, call):
+    # The child's result, or its traceback, so the parent never waits on a queue nothing will be put on
+    try:
+        results.put(("ok", call()))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+
+def wait_for_child(process, results, description, timeout=None):
+    # Polls the queue and the child's exit code, so a child that crashed outright (killed, out of memory,
+    # interpreter error before put_outcome) raises instead of hanging the benchmark
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            status, value = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if process.exitcode is not None:
+                # A child that put its result just before exiting has flushed it; take it if it is there
+                try:
+                    status, value = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    process.join()
+                    raise RuntimeError(f"{description} exited with code {process.exitcode} without a result")
+            if deadline is not None and time.monotonic() >= deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"{description} did not finish within {timeout} seconds")
+    process.join()
+    if status == "error":
+        raise RuntimeError(f"{description} failed in its benchmark process:\n{value}")
+    return value
+
+def _stitch_streaming(audio_paths, output_path):
+    from text_to_audio import stitch_audio_segments
+    stitch_audio_segments(audio_paths, output_path)
+
+def _stitch_pydub(audio_paths, output_path):
+    from text_to_audio import stitch_audio_segments_pydub
+    stitch_audio_segments_pydub(audio_paths, output_path)
+
+def write_fake_segments(output_dir, total_minutes, segment_minutes=4, sample_rate=24000, bitrate=160000):
+    # Silent frames in the same format as tts-1 output; decoding them costs pydub as much as speech would
+    segment = mp3_frames.silence(2.0, bitrate, sample_rate, 1, segment_minutes * 60 * 1000)
+    paths = []
+    for i in range(max(1, round(total_minutes / segment_minutes))):
+        path = Path(output_dir) / f"segment_{i+1}.mp3"
+        path.write_bytes(segment)
+        paths.append(path)
+    return paths
+
+def bench_stitch(minutes_list=(10, 60, 180), include_pydub=True):
+    stitchers = [("streaming", _stitch_streaming)]
+    if include_pydub:
+        stitchers.append(("pydub", _stitch_pydub))
+    for minutes in minutes_list:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            audio_paths = write_fake_segments(temp_dir, minutes)
+            for name, stitcher in stitchers:
+                output_path = Path(temp_dir) / f"{name}.mp3"
+                try:
+                    elapsed, peak_mb = run_in_fresh_process(stitcher, audio_paths, output_path)
+                except RuntimeError as e:
+                    logging.error(f"stitch {minutes:>4} min  {name:<10} {e}")
+                    continue
+                logging.info(f"stitch {minutes:>4} min  {name:<10} {elapsed:8.2f} s  peak RSS {peak_mb:8.1f} MB")
+
+def _video_still(audio_path, output_path):
+    from audio_to_video import audio_to_video
+    audio_to_video(audio_path, output_path, still=True)
+
+def _video_moviepy(audio_path, output_path):
+    from audio_to_video import audio_to_video
+    audio_to_video(audio_path, output_path, still=False)
+
+def bench_video(minutes_list=(1, 10, 60), include_moviepy=True):
+    renderers = [("still", _video_still)]
+    if include_moviepy:
+        renderers.append(("moviepy", _video_moviepy))
+    for minutes in minutes_list:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            audio_path = Path(temp_dir) / "story.mp3"
+            audio_path.write_bytes(mp3_frames.silence(2.0, 160000, 24000, 1, minutes * 60 * 1000))
+            for name, renderer in renderers:
+                output_path = Path(temp_dir) / f"{name}.mp4"
+                # A renderer that fails (no ffmpeg, no moviepy) is reported and the others still run
+                try:
+                    elapsed, peak_mb = run_in_fresh_process(renderer, audio_path, output_path)
+                except RuntimeError as e:
+                    logging.error(f"video  {minutes:>4} min  {name:<10} {e}")
+                    continue
+                size_mb = output_path.stat().st_size / 1024 ** 2 if output_path.exists() else 0
+                logging.info(f"video  {minutes:>4} min  {name:<10} {elapsed:8.2f} s  peak RSS {peak_mb:8.1f} MB  output {size_mb:7.1f} MB")
+
+def legacy_split_text_into_segments(input_text, max_chars=4000):
+    # The paragraph-only splitter text_to_audio used before, kept here as the baseline
+    segments = []
+    current_segment = ""
+    paragraphs = input_text.split("\n\n")
+    for paragraph in paragraphs:
+        if len(current_segment) + len(paragraph) + 2 <= max_chars:
+            current_segment += paragraph + "\n\n"
+        else:
+            segments.append(current_segment.strip())
+            current_segment = paragraph + "\n\n"
+    if current_segment:
+        segments.append(current_segment.strip())
+    return segments
+
+def bench_segment(megabytes_list=(1, 8, 32), max_chars=4096):
+    from fake_openai import fake_text
+    from text_to_audio import split_text_into_segments
+
+    splitters = [("sentence", lambda text: split_text_into_segments(text, max_chars)), ("legacy", lambda text: legacy_split_text_into_segments(text, max_chars))]
+    sample = "\n\n".join(fake_text(seed, 700) for seed in range(50))
+    for megabytes in megabytes_list:
+        text = (sample + "\n\n") * max(1, round(megabytes * 1024 ** 2 / (len(sample) + 2)))
+        for name, splitter in splitters:
+            start_time = time.perf_counter()
+            segments = splitter(text)
+            elapsed = time.perf_counter() - start_time
+            lengths = [len(segment) for segment in segments]
+            logging.info(f"segment {len(text) / 1024 ** 2:6.1f} MB  {name:<9} {len(text) / 1024 ** 2 / elapsed:8.1f} MB/s  "
+                         f"{len(segments):6d} segments  length min {min(lengths)} / max {max(lengths)} / stdev {statistics.pstdev(lengths):.0f}")
+
+def legacy_clean_story_text(story_text):
+    # The six-pass cleaner clean_story_text used before, kept here as the baseline
+    import re
+    story_text = story_text.replace('*', '')
+    story_text = re.sub(r'\s*-\s*', ' ', story_text)
+    story_text = re.sub(r'\s*subtitle:.*?(?=[.?!]|\n|$)', '', story_text, flags=re.IGNORECASE)
+    story_text = re.sub(r'\s*#\s*', '', story_text)
+    story_text = re.sub(r'Segment \d+', '', story_text, flags=re.IGNORECASE)
+    seen_chapters = set()
+    cleaned_lines = []
+    for line in story_text.split('\n'):
+        chapter_match = re.match(r'(CHAPTER \d+:.*)', line, re.IGNORECASE)
+        if chapter_match:
+            chapter_title = chapter_match.group(1).upper()
+            if chapter_title not in seen_chapters:
+                seen_chapters.add(chapter_title)
+                cleaned_lines.append(chapter_title)
+        else:
+            cleaned_lines.append(line)
+    return "\n".join(cleaned_lines).strip()
+
+def bench_clean(megabytes_list=(1, 8, 32)):
+    from fake_openai import fake_text
+    from clean_story_text import clean_story_text, clean_story_file
+
+    # Prose with a hyphenated word and a colon in most paragraphs, so the clean-up rules actually fire
+    prose = [fake_text(seed, 700).replace(" stone ", " stone-cold ").replace(" map ", " map: ") for seed in (1, 2)]
+    chapter = "\n\n".join(["## CHAPTER 1: The **Storm**", "Segment 1", "Subtitle: the long night.", prose[0], "- - -", prose[1]])
+    for megabytes in megabytes_list:
+        text = (chapter + "\n\n") * max(1, round(megabytes * 1024 ** 2 / (len(chapter) + 2)))
+        runs = [("single-pass", clean_story_text), ("legacy", legacy_clean_story_text)]
+        for name, cleaner in runs:
+            start_time = time.perf_counter()
+            cleaner(text)
+            elapsed = time.perf_counter() - start_time
+            logging.info(f"clean {len(text) / 1024 ** 2:6.1f} MB  {name:<12} {len(text) / 1024 ** 2 / elapsed:8.1f} MB/s")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = Path(temp_dir) / "story.txt"
+            input_path.write_text(text, encoding="utf-8")
+            start_time = time.perf_counter()
+            clean_story_file(input_path, Path(temp_dir) / "story_cleaned.txt")
+            elapsed = time.perf_counter() - start_time
+            logging.info(f"clean {len(text) / 1024 ** 2:6.1f} MB  {'file stream':<12} {len(text) / 1024 ** 2 / elapsed:8.1f} MB/s")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Per-minute limit for the fake client that no benchmark reaches
+UNLIMITED = 10 ** 9
+
+def _run_fake_stories(story_count, concurrency, latency_scale, skip_video, error_rate, stream_audio=False):
+    # Runs in its own process and working directory; story folders are created relative to the cwd
+    from fake_openai import FakeOpenAI
+    from metrics import MetricsRecorder, instrument
+    from openai_client import wrap_client
+    from pipeline import run_stages
+    from story_creation_main import story_stages
+
+    logging.getLogger().setLevel(logging.WARNING)
+    fake_client = FakeOpenAI(latency_scale=latency_scale, rate_limit_error_rate=error_rate / 2, server_error_rate=error_rate / 2)
+    recorder = MetricsRecorder()
+    # Same rate limiting and retry as the real client, so injected 429/5xx errors are retried like in production.
+    # The fake has no quota of its own, so the limits are set out of reach instead of the real account's defaults
+    client = instrument(wrap_client(fake_client, requests_per_minute=UNLIMITED, tokens_per_minute=UNLIMITED), recorder)
+    stage_durations = {}
+    failures = 0
+
+    def run_story(index):
+        topic = f"Benchmark story {index + 1}"
+        stages = story_stages(client, "fake-key", topic, {topic: "A quiet harbor town with an old secret."}, stream_audio=stream_audio)
+        if skip_video:
+            stages = [stage for stage in stages if stage.name != "video"]
+        timings = {}
+        try:
+            run_stages(stages, label=topic, timings=timings)
+        finally:
+            for name, timing in timings.items():
+                stage_durations.setdefault(name, []).append(timing.duration)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run_story, index) for index in range(story_count)]:
+            try:
+                future.result()
+            except Exception:
+                failures += 1
+    elapsed = time.perf_counter() - start_time
+    return {
+        "elapsed": elapsed,
+        "failures": failures,
+        "stage_durations": stage_durations,
+        "calls": dict(fake_client.calls),
+        "errors": dict(fake_client.errors),
+        "cost": recorder.total_cost(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def _pipeline_child(results, story_count, concurrency, latency_scale, skip_video, error_rate, stream_audio):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        put_outcome(results, lambda: _run_fake_stories(story_count, concurrency, latency_scale, skip_video, error_rate, stream_audio))
+
+def bench_pipeline(story_counts=(1, 10, 100), concurrency=4, latency_scale=0.05, skip_video=True, error_rate=0.0, stream_audio=False):
+    # End-to-end story_creation_main stages against the local FakeOpenAI stand-in, one fresh process per story count
+    context = multiprocessing.get_context("spawn")
+    for story_count in story_counts:
+        results = context.Queue()
+        process = context.Process(target=_pipeline_child, args=(results, story_count, concurrency, latency_scale, skip_video, error_rate, stream_audio))
+        process.start()
+        try:
+            report = wait_for_child(process, results, f"pipeline with {story_count} stories")
+        except RuntimeError as e:
+            logging.error(str(e))
+            continue
+
+        logging.info(f"pipeline {story_count:>4} stories: {report['elapsed']:8.2f} s wall clock, "
+                     f"{story_count / report['elapsed'] * 3600:8.1f} stories/hour, {report['failures']} failed, "
+                     f"peak RSS {report['peak_rss_mb']:.1f} MB, list-price cost ${report['cost']:.2f}")
+        logging.info(f"  API calls: {report['calls']}  errors: {report['errors']}")
+        for name, durations in report["stage_durations"].items():
+            logging.info(f"  {name:<10} mean {statistics.mean(durations):7.2f} s  p50 {percentile(durations, 0.5):7.2f} s  p95 {percentile(durations, 0.95):7.2f} s")
+
+# Modules that take a noticeable share of startup time and should only load in the stages that use them
+HEAVY_MODULES = ("openai", "httpx", "pydantic", "requests", "pydub", "PIL", "moviepy", "numpy")
+
+def bench_imports(modules=("cli", "story_creation_main", "generate_story", "text_to_audio", "generate_image", "audio_to_video"), repeats=5):
+    # Each import is timed in a fresh interpreter so nothing is cached in sys.modules from an earlier one
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import {module}\n"
+            "elapsed = time.perf_counter() - start\n"
+            f"print(elapsed, *[name for name in {HEAVY_MODULES!r} if name in sys.modules])")
+    project_dir = Path(__file__).resolve().parent
+    for module in modules:
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", code.format(module=module)], cwd=project_dir, capture_output=True, text=True, check=True).stdout.split()
+            timings.append(float(output[0]))
+        heavy = ", ".join(output[1:]) or "none"
+        logging.info(f"import {module:<20} median {statistics.median(timings) * 1000:7.1f} ms, heavy modules loaded: {heavy}")
+
+    # Whole process, interpreter startup included, for the command a user types most
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "cli.py", "--help"], cwd=project_dir, capture_output=True, check=True)
+        timings.append(time.perf_counter() - start_time)
+    logging.info(f"python cli.py --help    median {statistics.median(timings) * 1000:7.1f} ms wall clock")
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Benchmarks for the story pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    stitch_parser = subparsers.add_parser("stitch", help="Streaming frame stitcher vs the pydub re-encode path")
+    stitch_parser.add_argument("--minutes", type=int, nargs="+", default=[10, 60, 180])
+    stitch_parser.add_argument("--skip-pydub", action="store_true")
+
+    video_parser = subparsers.add_parser("video", help="Still-image ffmpeg renderer vs the moviepy frame-by-frame path")
+    video_parser.add_argument("--minutes", type=int, nargs="+", default=[1, 10, 60])
+    video_parser.add_argument("--skip-moviepy", action="store_true")
+
+    segment_parser = subparsers.add_parser("segment", help="Text segmenter throughput on multi-megabyte inputs")
+    segment_parser.add_argument("--megabytes", type=int, nargs="+", default=[1, 8, 32])
+
+    clean_parser = subparsers.add_parser("clean", help="Single-pass story cleaner vs the old six-pass cleaner")
+    clean_parser.add_argument("--megabytes", type=int, nargs="+", default=[1, 8, 32])
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Whole story pipeline against the local fake OpenAI client")
+    pipeline_parser.add_argument("--stories", type=int, nargs="+", default=[1, 10, 100])
+    pipeline_parser.add_argument("--concurrency", type=int, default=4, help="Stories in flight at once")
+    pipeline_parser.add_argument("--latency-scale", type=float, default=0.05, help="Multiplier on the fake API latencies")
+    pipeline_parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls failing with 429/5xx")
+    pipeline_parser.add_argument("--stream-audio", action="store_true", help="Narrate each story while it is being generated")
+    pipeline_parser.add_argument("--with-video", action="store_true", help="Also render videos (needs ffmpeg)")
+
+    imports_parser = subparsers.add_parser("imports", help="Import time of the entry points and which heavy modules they load")
+    imports_parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.benchmark == "stitch":
+        bench_stitch(args.minutes, include_pydub=not args.skip_pydub)
+    elif args.benchmark == "video":
+        bench_video(args.minutes, include_moviepy=not args.skip_moviepy)
+    elif args.benchmark == "segment":
+        bench_segment(args.megabytes)
+    elif args.benchmark == "clean":
+        bench_clean(args.megabytes)
+    elif args.benchmark == "pipeline":
+        bench_pipeline(args.stories, args.concurrency, args.latency_scale, not args.with_video, args.error_rate, args.stream_audio)
+    elif args.benchmark == "imports":
+        bench_imports(repeats=args.repeats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from generate_story import (SUMMARY_SYSTEM_PROMPT, INTRO_SYSTEM_PROMPT, build_messages, build_intro_prompt,
+                            generate_summary, generate_intro, story_folder)
+from metrics import batch_chat_fields
+from openai_client import call_with_retry
+from run_manifest import load_manifest, content_hash
+
+# Offline mode for the calls nobody waits on: story summaries (and the image prompts built from them) for finished
+# stories, and intros for topics that are about to be written. The requests go into one JSONL file in the Batch API
+# format, which is submitted and polled until it completes (within 24 hours, at half the token price and outside
+# the per-minute limits). The results are recorded in each story folder's manifest, where the summary and story
+# stages pick them up instead of calling the API. Anything the batch could not answer is done the normal way.
+# Images have no batch endpoint, so --images generates them afterwards through the usual concurrent path.
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_MODEL = "gpt-4o"
+STATE_FILENAME = "bulk_batch.json"
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def find_story_folders(root="."):
+    # Folders under root whose manifest records a finished story
+    return sorted(str(path.parent) for path in Path(root).glob("*/manifest.json") if load_manifest(path.parent).get("story"))
+
+def collect_summary_requests(story_folders, max_tokens=4095):
+    requests = []
+    for folder in story_folders:
+        manifest = load_manifest(folder)
+        story_entry = manifest.get("story")
+        if not story_entry or not os.path.exists(story_entry["path"]):
+            logging.warning(f"No finished story in {folder}, skipping its summary")
+            continue
+        with open(story_entry["path"], "r", encoding="utf-8") as story_file:
+            story_text = story_file.read()
+        story_hash = content_hash(story_text)
+        # Same hash the summary stage checks, so a story that changed since gets a new summary
+        if manifest.is_done("summary", story_hash):
+            continue
+        # Stories written before the topic was recorded fall back to the folder name
+        topic = story_entry.get("topic") or Path(folder).name
+        requests.append({"custom_id": f"summary:{folder}", "kind": "summary", "folder": str(folder), "topic": topic, "hash": story_hash, "story_path": story_entry["path"], "max_tokens": max_tokens,
+                         "body": {"model": BATCH_MODEL, "messages": build_messages(story_text, SUMMARY_SYSTEM_PROMPT), "max_tokens": max_tokens}})
+    return requests
+
+def collect_intro_requests(jobs, max_tokens=500):
+    # jobs are batch runner job specs; the intro lands where generate_story looks for it before writing segment 1
+    requests = []
+    for job in jobs:
+        folder = story_folder(job["topic"])
+        if load_manifest(folder).get("story/intro"):
+            continue
+        intro_prompt = build_intro_prompt(job["topic"], job["world_details"])
+        requests.append({"custom_id": f"intro:{folder}", "kind": "intro", "folder": folder, "topic": job["topic"], "world_details": job["world_details"], "max_tokens": max_tokens,
+                         "prompt_hash": content_hash(intro_prompt), "body": {"model": BATCH_MODEL, "messages": build_messages(intro_prompt, INTRO_SYSTEM_PROMPT), "max_tokens": max_tokens}})
+    return requests
+
+def write_batch_file(requests, path):
+    with open(path, "w", encoding="utf-8") as batch_file:
+        for request in requests:
+            batch_file.write(json.dumps({"custom_id": request["custom_id"], "method": "POST", "url": BATCH_ENDPOINT, "body": request["body"]}) + "\n")
+    return path
+
+def submit_batch(client, batch_path, description="story bulk requests"):
+    def upload():
+        # A fresh handle per attempt, so a retry sends the whole file again
+        with open(batch_path, "rb") as batch_file:
+            return client.files.create(file=batch_file, purpose="batch")
+
+    input_file = call_with_retry(upload, description="Batch file upload")
+    batch = call_with_retry(lambda: client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h",
+                                                          metadata={"description": description}), description="Batch creation")
+    logging.info(f"Submitted batch {batch.id} with {batch.request_counts.total if batch.request_counts else '?'} requests from {batch_path}")
+    return batch
+
+def wait_for_batch(client, batch_id, poll_seconds=60, timeout=None):
+    # Polls until the batch finishes; returns the last batch object, finished or not when timeout runs out
+    start = time.time()
+    last_counts = None
+    while True:
+        batch = call_with_retry(lambda: client.batches.retrieve(batch_id), description="Batch status")
+        counts = batch.request_counts
+        progress = (batch.status, counts.completed, counts.failed) if counts else (batch.status,)
+        if progress != last_counts:
+            logging.info(f"Batch {batch_id}: {batch.status}" + (f", {counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""))
+            last_counts = progress
+        if batch.status in FINISHED_STATUSES or (timeout is not None and time.time() - start >= timeout):
+            return batch
+        time.sleep(poll_seconds)
+
+def read_batch_results(client, batch):
+    # custom_id -> result line, from the output file and the error file
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = call_with_retry(lambda: client.files.content(file_id), description="Batch results download").read().decode("utf-8")
+        for line in content.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                results[result["custom_id"]] = result
+    return results
+
+def result_text(result):
+    # The completion text, or None when the request failed
+    response = (result or {}).get("response") or {}
+    if result is None or result.get("error") or response.get("status_code") != 200:
+        return None
+    content = response["body"]["choices"][0]["message"]["content"]
+    return content.strip() if content and content.strip() else None
+
+def apply_result(request, text):
+    manifest = load_manifest(request["folder"])
+    if request["kind"] == "summary":
+        manifest.record("summary", request["hash"], text=text)
+    else:
+        # prompt_hash lets generate_story keep the intro when it starts the story without --resume
+        manifest.record("story/intro", content_hash(text), text=text, prompt_hash=request["prompt_hash"])
+
+def run_sync(client, request):
+    # The normal one-at-a-time call, for requests the batch did not answer
+    if request["kind"] == "summary":
+        with open(request["story_path"], "r", encoding="utf-8") as story_file:
+            text, _ = generate_summary(client, story_file.read(), max_tokens=request["max_tokens"])
+    else:
+        text, _, _ = generate_intro(client, request["topic"], request["world_details"], max_tokens=request["max_tokens"])
+    return text or None
+
+def record_usage(client, request, result):
+    # Batch results never pass through the instrumented client, so they are recorded here at the batch price,
+    # labelled with the topic like the story's other calls
+    recorder = getattr(client, "recorder", None)
+    if recorder is None:
+        return
+    body = result["response"]["body"]
+    recorder.record_call(endpoint="batch", model=body.get("model", BATCH_MODEL), latency=0.0, retries=0, **batch_chat_fields(body.get("model", BATCH_MODEL), body["usage"]),
+                         **{**getattr(client, "labels", {}), "story": request["topic"], "stage": request["kind"]})
+
+def run_bulk(client, story_folders=(), intro_jobs=(), state_dir=".", poll_seconds=60, timeout=None, image_count=0):
+    # Safe to stop and run again: the submitted batch is remembered in <state_dir>/bulk_batch.json and polled
+    # again instead of being submitted twice, until its results have been applied
+    state_path = Path(state_dir) / STATE_FILENAME
+    if state_path.exists():
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        logging.info(f"Continuing batch {state['batch_id']} from {state_path}")
+    else:
+        requests = collect_summary_requests(story_folders) + collect_intro_requests(intro_jobs)
+        if not requests:
+            logging.info("Every summary and intro is already recorded, nothing to submit")
+            return {"batched": 0, "fallback": 0, "failed": 0}
+        os.makedirs(state_dir, exist_ok=True)
+        batch_path = write_batch_file(requests, Path(state_dir) / "bulk_batch_input.jsonl")
+        batch = submit_batch(client, batch_path)
+        # The prompts are in the uploaded file; the state only needs what it takes to apply or redo each result
+        state = {"batch_id": batch.id, "requests": [{key: value for key, value in request.items() if key != "body"} for request in requests]}
+        with open(state_path, "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file)
+
+    batch = wait_for_batch(client, state["batch_id"], poll_seconds, timeout)
+    if batch.status not in FINISHED_STATUSES:
+        logging.info(f"Batch {batch.id} is still {batch.status}; run the same command again later to collect it")
+        return None
+
+    results = read_batch_results(client, batch)
+    counts = {"batched": 0, "fallback": 0, "failed": 0}
+    for request in state["requests"]:
+        result = results.get(request["custom_id"])
+        text = result_text(result)
+        if text is not None:
+            record_usage(client, request, result)
+            counts["batched"] += 1
+        else:
+            logging.warning(f"Batch {batch.id} ({batch.status}) did not answer {request['custom_id']}, making the call directly")
+            text = run_sync(client, request)
+            counts["fallback" if text else "failed"] += 1
+        if text:
+            apply_result(request, text)
+    os.remove(state_path)
+    logging.info(f"Bulk requests: {counts['batched']} answered by batch {batch.id}, {counts['fallback']} by direct calls, {counts['failed']} failed")
+
+    if image_count:
+        generate_story_images(client, story_folders, image_count)
+    return counts
+
+def generate_story_images(client, story_folders, image_count):
+    # Images already recorded for the current summary are skipped by generate_images
+    from story_creation_main import generate_images
+
+    for folder in story_folders:
+        manifest = load_manifest(folder)
+        story_entry, summary = manifest.get("story"), manifest.get("summary")
+        if story_entry and summary:
+            generate_images(client, story_entry["path"], summary["text"], image_count=image_count, manifest=manifest)
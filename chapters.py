@@ -0,0 +1,58 @@
+import json
+import logging
+import string
+
+from clean_story_text import CHAPTER_PATTERN
+
+# Chapter index for the narrated story, from the segment each "CHAPTER N:" heading was synthesized in and where
+# that segment starts in the stitched MP3. Written as JSON, as YouTube description timestamps and as ffmpeg
+# chapter metadata that audio_to_video can put into the MP4.
+
+def is_chapter_heading(paragraph):
+    return CHAPTER_PATTERN.match(paragraph) is not None
+
+def chapter_title(heading):
+    # The cleaner upper-cases headings; "CHAPTER 2: THE SILVER KEY" reads better as "Chapter 2: The Silver Key"
+    return string.capwords(heading.split("\n", 1)[0].strip().lower())
+
+def build_chapters(segments, segment_starts, total_seconds, intro_title="Introduction"):
+    # Segments break before every heading (see iter_text_segments' break_before), so a chapter starts with its segment.
+    # The title and intro come before the first heading and become the chapter at 0:00 that YouTube requires.
+    chapters = [{"title": chapter_title(segment), "start": start} for segment, start in zip(segments, segment_starts) if is_chapter_heading(segment)]
+    if not chapters or chapters[0]["start"] > segment_starts[0]:
+        chapters.insert(0, {"title": intro_title, "start": 0.0})
+    chapters[0]["start"] = 0.0  # The initial silence belongs to the first chapter
+    for chapter, next_chapter in zip(chapters, chapters[1:] + [{"start": total_seconds}]):
+        chapter["start"] = round(chapter["start"], 3)
+        chapter["end"] = round(next_chapter["start"], 3)
+    return chapters
+
+def youtube_timestamp(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def ffmetadata_escape(value):
+    for character in "\\=;#\n":
+        value = value.replace(character, "\\" + character)
+    return value
+
+def write_chapter_files(chapters, output_stem):
+    # <stem>_chapters.json, <stem>_chapters.txt (paste into a YouTube description) and <stem>_chapters.ffmetadata
+    json_path = output_stem.with_name(f"{output_stem.name}_chapters.json")
+    text_path = output_stem.with_name(f"{output_stem.name}_chapters.txt")
+    ffmetadata_path = output_stem.with_name(f"{output_stem.name}_chapters.ffmetadata")
+
+    with open(json_path, "w", encoding="utf-8") as json_file:
+        json.dump(chapters, json_file, indent=2)
+    with open(text_path, "w", encoding="utf-8") as text_file:
+        text_file.write("".join(f"{youtube_timestamp(chapter['start'])} {chapter['title']}\n" for chapter in chapters))
+    with open(ffmetadata_path, "w", encoding="utf-8") as ffmetadata_file:
+        ffmetadata_file.write(";FFMETADATA1\n")
+        for chapter in chapters:
+            ffmetadata_file.write(f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={int(chapter['start'] * 1000)}\nEND={int(chapter['end'] * 1000)}\ntitle={ffmetadata_escape(chapter['title'])}\n")
+
+    if len(chapters) < 3 or any(chapter["end"] - chapter["start"] < 10 for chapter in chapters):
+        logging.info("YouTube only shows chapters when there are at least 3, each 10 seconds or longer")
+    logging.info(f"Chapter index with {len(chapters)} chapters saved to {json_path}, {text_path} and {ffmetadata_path}")
+    return [json_path, text_path, ffmetadata_path]
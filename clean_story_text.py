@@ -1,51 +1,98 @@
 import re
+import sys
 
-def clean_story_text(story_text):
-    # Step 1: Remove all asterisks
-    story_text = story_text.replace('*', '')
-
-    # Step 2: Remove all "-" in sequence unless within paragraph text
-    story_text = re.sub(r'\s*-\s*', ' ', story_text)
-
-    # Step 3: Remove all subtitles including the content following "Subtitle:" or any case variation
-    story_text = re.sub(r'\s*subtitle:.*?(?=[.?!]|\n|$)', '', story_text, flags=re.IGNORECASE)
+# Precompiled clean-up rules, applied line by line in a single pass over the story. Each rule only runs on lines
+# containing its trigger character, which keeps the common case (plain prose) to a few substring checks.
+DASH_PATTERN = re.compile(r"[ \t]*-[ \t]*")
+SUBTITLE_PATTERN = re.compile(r"[ \t]*subtitle:.*?(?=[.?!]|$)", re.IGNORECASE)
+HASH_PATTERN = re.compile(r"[ \t]*#[ \t]*")
+SEGMENT_PATTERN = re.compile(r"Segment \d+", re.IGNORECASE)
+CHAPTER_PATTERN = re.compile(r"(CHAPTER \d+:.*)", re.IGNORECASE)
 
-    # Step 4: Remove all "#" found in the document except within a sentence
-    story_text = re.sub(r'\s*#\s*', '', story_text)
+def clean_line(line):
+    # Remove all asterisks
+    if "*" in line:
+        line = line.replace("*", "")
+    # Replace every "-" and the spacing around it with a single space
+    if "-" in line:
+        line = DASH_PATTERN.sub(" ", line)
+    # Remove subtitles, from "Subtitle:" (any case) up to the end of the sentence
+    if ":" in line:
+        line = SUBTITLE_PATTERN.sub("", line)
+    # Remove all "#" marks
+    if "#" in line:
+        line = HASH_PATTERN.sub("", line)
+    # Remove all occurrences of "Segment" followed by a space and a digit
+    if "egment" in line.lower():
+        line = SEGMENT_PATTERN.sub("", line)
+    return line
 
-    # Step 5: Remove all occurrences of "Segment" followed by a space and a digit
-    story_text = re.sub(r'Segment \d+', '', story_text, flags=re.IGNORECASE)
-
-    # Step 6: Retain only the first instance of each "CHAPTER" followed by an integer digit and title
+def iter_clean_lines(lines):
+    # Yields cleaned lines without their newlines; leading and trailing blank lines are dropped like the old strip()
     seen_chapters = set()
-    cleaned_lines = []
-    for line in story_text.split('\n'):
-        chapter_match = re.match(r'(CHAPTER \d+:.*)', line, re.IGNORECASE)
+    blank_lines = 0
+    started = False
+    for line in lines:
+        line = clean_line(line.rstrip("\r\n")).rstrip()
+
+        # Retain only the first instance of each "CHAPTER" followed by an integer digit and title
+        chapter_match = CHAPTER_PATTERN.match(line)
         if chapter_match:
-            chapter_title = chapter_match.group(1).upper()
-            if chapter_title not in seen_chapters:
-                seen_chapters.add(chapter_title)
-                cleaned_lines.append(chapter_title)
+            line = chapter_match.group(1).upper()
+            if line in seen_chapters:
+                continue
+            seen_chapters.add(line)
+
+        if not line:
+            blank_lines += 1
+            continue
+        if started:
+            yield from [""] * blank_lines
         else:
-            cleaned_lines.append(line)
+            line = line.lstrip()
+            started = True
+        blank_lines = 0
+        yield line
 
-    cleaned_text = "\n".join(cleaned_lines)
+def iter_clean_paragraphs(paragraphs):
+    # Same rules for a story that arrives paragraph by paragraph; yields cleaned paragraphs as soon as each one ends
+    def lines():
+        for paragraph in paragraphs:
+            yield from paragraph.split("\n")
+            yield ""
 
-    return cleaned_text.strip()
+    paragraph_lines = []
+    for line in iter_clean_lines(lines()):
+        if line:
+            paragraph_lines.append(line)
+        elif paragraph_lines:
+            yield "\n".join(paragraph_lines)
+            paragraph_lines = []
+    if paragraph_lines:
+        yield "\n".join(paragraph_lines)
 
-def main():
-    # Read the content of the existing text file
-    with open('generated_story.txt', 'r', encoding='utf-8') as file:
-        story_text = file.read()
+def clean_story_text(story_text):
+    return "\n".join(iter_clean_lines(story_text.split("\n")))
 
-    # Clean the story text
-    cleaned_story_text = clean_story_text(story_text)
+def clean_story_file(input_path, output_path):
+    # Streams the story through the cleaner, so memory stays flat however long the file is
+    with open(input_path, "r", encoding="utf-8") as input_file, open(output_path, "w", encoding="utf-8") as output_file:
+        first = True
+        for line in iter_clean_lines(input_file):
+            if not first:
+                output_file.write("\n")
+            output_file.write(line)
+            first = False
+    return output_path
+
+def main():
+    input_path = sys.argv[1] if len(sys.argv) > 1 else 'generated_story.txt'
+    output_path = sys.argv[2] if len(sys.argv) > 2 else 'cleaned_story.txt'
 
-    # Save the cleaned story text to a new file
-    with open('cleaned_story.txt', 'w') as file:
-        file.write(cleaned_story_text)
+    # Clean the story text and save it to a new file
+    clean_story_file(input_path, output_path)
 
-    print("Story has been cleaned and saved to 'cleaned_story.txt'.")
+    print(f"Story has been cleaned and saved to '{output_path}'.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+
+# Command line entry point: python cli.py <story|clean|audio|video|images|all|batch|bulk|serve|plan> [options]
+# Each command imports the stage modules it needs when it runs, so `python cli.py clean` or `--help` never loads
+# the OpenAI SDK, and pydub, PIL and moviepy only load inside the code paths that actually use them.
+
+# Used when neither --config nor --topic is given
+DEFAULT_CONFIG = {
+    "topics": ["The mysterious Island of Atlantis"],
+    # In the format of "title": "World Description"
+    "world_details": {"The mysterious Island of Atlantis": "Atlantis is a legendary island first mentioned in Plato's dialogues Timaeus and Critias, written about 360 BC. According to Plato, Atlantis was a naval power lying beyond the Pillars of Hercules that conquered many parts of Western Europe and Africa 9,000 years before the time of Solon, or approximately 9600 BC. After a failed attempt to invade Athens, Atlantis sank into the ocean in a single day and night of misfortune . The island was said to be larger than Asia and Libya combined, and was the home of a technologically advanced civilization. The story of Atlantis has captivated the imagination of people for centuries, with many theories and speculations about its possible location and existence."},
+    # The audience of the story as appropriate ex/ "all", "children", "adults"
+    "audience": "all",
+    # Length of each story in tokens, and the most one call may write; size these with `python cli.py plan`
+    "total_token_limit": 10000,
+    "max_tokens_per_call": 4095,
+}
+
+def load_config(config_path=None, topics=None, world=None, audience=None, total_token_limit=None, max_tokens_per_call=None):
+    # Defaults, then the JSON config file, then command line arguments
+    config = dict(DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            config.update(json.load(config_file))
+    if topics:
+        config["topics"] = topics
+    if world:
+        config["world_details"] = {**config.get("world_details", {}), **{topic: world for topic in config["topics"]}}
+    if audience:
+        config["audience"] = audience
+    if total_token_limit:
+        config["total_token_limit"] = total_token_limit
+    if max_tokens_per_call:
+        config["max_tokens_per_call"] = max_tokens_per_call
+    config.setdefault("world_details", {})
+    return config
+
+def make_client(recorder=None):
+    # The shared client pools connections, paces calls to the account's rate limits and retries failures;
+    # every call through it is timed and priced
+    from metrics import MetricsRecorder, instrument
+    from openai_client import get_client
+    return instrument(get_client(), recorder or MetricsRecorder())
+
+def command_story(args, config):
+    from generate_story import generate_story
+
+    client = make_client()
+    story_paths, total_cost = generate_story(None, config["topics"], config["world_details"], config["audience"], config["max_tokens_per_call"], config["total_token_limit"], resume=args.resume, stream=args.stream, client=client)
+    logging.info(f"Total cost for the stories: ${total_cost:.2f}")
+    for story_path in story_paths:
+        print(story_path)
+
+def command_clean(args, config):
+    from clean_story_text import clean_story_file
+
+    input_path = Path(args.input)
+    output_path = args.output or input_path.with_name(f"{input_path.stem}_cleaned.txt")
+    clean_story_file(input_path, output_path)
+    print(output_path)
+
+def command_audio(args, config):
+    from text_to_audio import text_to_audio
+
+    client = make_client()
+    final_audio_path = text_to_audio(client, args.input, max_workers=args.workers, cache_dir=args.tts_cache_dir, output_dir=args.output_dir, model=args.model, voice=args.voice,
+                                     requests_per_minute=args.tts_requests_per_minute)
+    client.recorder.log_summary()
+    print(final_audio_path)
+
+def command_video(args, config):
+    from audio_to_video import audio_to_video
+
+    audio_file = Path(args.input)
+    output_path = args.output or audio_file.with_suffix(".mp4")
+    chapters_file = args.chapters or audio_file.with_name(f"{audio_file.stem}_chapters.ffmetadata")
+    audio_to_video(str(audio_file), str(output_path), image_file=args.image, chapters_file=chapters_file if Path(chapters_file).exists() else None)
+    print(output_path)
+
+def command_images(args, config):
+    from generate_story import generate_summary
+    from run_manifest import load_manifest
+    from story_creation_main import generate_images, read_story_file
+
+    client = make_client()
+    summary, _ = generate_summary(client.with_labels(stage="summary"), read_story_file(args.input))
+    if not summary:
+        raise RuntimeError(f"Could not summarize {args.input} for the image prompt")
+    image_paths = generate_images(client.with_labels(stage="images"), args.input, summary, image_count=args.count, manifest=load_manifest(Path(args.input).parent))
+    client.recorder.log_summary()
+    for image_path in image_paths:
+        print(image_path)
+
+def command_all(args, config):
+    from metrics import MetricsRecorder
+    from pipeline import run_stages
+    from story_creation_main import story_stages
+
+    recorder = MetricsRecorder()
+    client = make_client(recorder)
+
+    # Summary and images run alongside the audio, the video waits for the final audio and the thumbnails
+    logging.info("The story creation process has begun, please wait... this may take a few minutes")
+    failed = []
+    for story_topic in config["topics"]:
+        stages = story_stages(client, None, story_topic, config["world_details"], intended_audience=config["audience"], resume=args.resume, stream_audio=args.stream_audio,
+                              total_token_limit=config["total_token_limit"], max_tokens_per_call=config["max_tokens_per_call"], tts_cache_dir=args.tts_cache_dir,
+                              tts_requests_per_minute=args.tts_requests_per_minute)
+        timings = {}
+        try:
+            run_stages(stages, label=story_topic, timings=timings)
+        except Exception as e:
+            logging.error(f"Story creation failed for '{story_topic}': {e}")
+            failed.append(story_topic)
+        for name, timing in timings.items():
+            recorder.record_stage(story_topic, name, timing.duration, timing.status)
+        logging.info(f"Total cost for '{story_topic}' including summary, images and audio: ${recorder.total_cost(story=story_topic):.4f}")
+
+    recorder.log_summary()
+    os.makedirs(args.metrics_dir, exist_ok=True)
+    recorder.write_json(os.path.join(args.metrics_dir, "metrics.json"))
+    recorder.write_prometheus(os.path.join(args.metrics_dir, "story_pipeline.prom"))
+    # The other stories still ran, but the exit status tells a script or scheduler that some did not finish
+    if failed:
+        logging.error(f"{len(failed)} of {len(config['topics'])} stories failed: {', '.join(failed)}")
+        return 1
+
+def command_plan(args, config):
+    from planner import plan_batch, log_plan
+
+    history = args.history if args.history is not None else [os.path.join(args.metrics_dir, "metrics.json")]
+    plan = plan_batch(config["topics"], config["world_details"], config["audience"], history,
+                      total_token_limit=config["total_token_limit"], max_tokens_per_call=config["max_tokens_per_call"], image_count=args.image_count)
+    if args.json:
+        print(json.dumps(plan, indent=2))
+    else:
+        log_plan(plan)
+
+def command_batch(args, config):
+    from batch_runner import run_batch, log_job_status
+    from job_queue import JobQueue
+
+    if args.status:
+        log_job_status(JobQueue(args.db))
+        return
+    summary = run_batch(args.db, args.input, workers=args.workers, max_attempts=args.max_attempts, retry_delay=args.retry_delay, metrics_dir=args.metrics_dir,
+                        tts_cache_dir=args.tts_cache_dir, tts_requests_per_minute=args.tts_requests_per_minute)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+
+def command_serve(args, config):
+    from daemon import serve, DEFAULT_STAGE_LIMITS, DAEMON_MAX_RECORDS
+    from metrics import MetricsRecorder
+
+    stage_limits = dict(DEFAULT_STAGE_LIMITS)
+    for limit in args.stage_limit:
+        stage, _, count = limit.partition("=")
+        if not count.isdigit() or int(count) < 1:
+            raise ValueError(f"--stage-limit expects STAGE=N with N at least 1, got '{limit}'")
+        stage_limits[stage] = int(count)
+    # The daemon runs for days; it keeps the latest records and running totals for /metrics
+    recorder = MetricsRecorder(max_records=DAEMON_MAX_RECORDS)
+    serve(make_client(recorder), recorder, args.db, host=args.host, port=args.port, story_workers=args.story_workers, stage_limits=stage_limits, retry_delay=args.retry_delay,
+          tts_cache_dir=args.tts_cache_dir, tts_requests_per_minute=args.tts_requests_per_minute)
+
+def command_bulk(args, config):
+    from batch_runner import load_jobs_file
+    from bulk_requests import run_bulk, find_story_folders
+
+    client = make_client()
+    story_folders = args.stories if args.stories is not None else find_story_folders()
+    intro_jobs = load_jobs_file(args.intros) if args.intros else []
+    run_bulk(client, story_folders, intro_jobs, state_dir=args.state_dir, poll_seconds=args.poll_seconds, timeout=args.timeout, image_count=args.images)
+    client.recorder.log_summary()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate stories, images, audio and video")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Story options, shared by the commands that start from a topic
+    topic_options = argparse.ArgumentParser(add_help=False)
+    topic_options.add_argument("--config", help='JSON file with "topics", "world_details" and "audience"')
+    topic_options.add_argument("--topic", action="append", dest="topics", help="Story topic, repeat for several (overrides the config file)")
+    topic_options.add_argument("--world", help="World details for the given topics")
+    topic_options.add_argument("--audience", help='Intended audience, e.g. "all", "children", "adults"')
+    topic_options.add_argument("--total-token-limit", type=int, help="Length of each story in tokens")
+    topic_options.add_argument("--max-tokens-per-call", type=int, help="Most tokens one story call may write")
+    topic_options.add_argument("--resume", action="store_true", help="Skip work recorded as finished in each story's manifest.json and continue from the first incomplete unit")
+
+    # Speech options, shared by the commands that narrate
+    tts_options = argparse.ArgumentParser(add_help=False)
+    tts_options.add_argument("--tts-cache-dir", help="One TTS cache shared by every story, so text already narrated for another story is not paid for again (default: a .tts_cache folder in each story folder)")
+    tts_options.add_argument("--tts-requests-per-minute", type=int, help="Most speech requests per minute, below the account limit the response headers report")
+
+    story_parser = subparsers.add_parser("story", parents=[topic_options], help="Generate the story text")
+    story_parser.add_argument("--stream", action="store_true", help="Stream each segment to <story>.partial.txt as it is written")
+    story_parser.set_defaults(handler=command_story)
+
+    clean_parser = subparsers.add_parser("clean", help="Strip markdown and segment artifacts from a story file")
+    clean_parser.add_argument("input")
+    clean_parser.add_argument("output", nargs="?", help="Defaults to <input>_cleaned.txt")
+    clean_parser.set_defaults(handler=command_clean)
+
+    audio_parser = subparsers.add_parser("audio", parents=[tts_options], help="Narrate a (cleaned) story file to MP3")
+    audio_parser.add_argument("input")
+    audio_parser.add_argument("--output-dir", help="Defaults to a folder named after the input file")
+    audio_parser.add_argument("--workers", type=int, default=4)
+    audio_parser.add_argument("--model", default="tts-1")
+    audio_parser.add_argument("--voice", default="fable")
+    audio_parser.set_defaults(handler=command_audio)
+
+    video_parser = subparsers.add_parser("video", help="Turn an MP3 into an MP4 with a still image")
+    video_parser.add_argument("input")
+    video_parser.add_argument("output", nargs="?", help="Defaults to the input name with .mp4")
+    video_parser.add_argument("--image", help="Still frame, black when not given")
+    video_parser.add_argument("--chapters", help="ffmetadata chapter file (default: <input>_chapters.ffmetadata when it exists)")
+    video_parser.set_defaults(handler=command_video)
+
+    images_parser = subparsers.add_parser("images", help="Summarize a story file and generate images for it")
+    images_parser.add_argument("input")
+    images_parser.add_argument("--count", type=int, default=4)
+    images_parser.set_defaults(handler=command_images)
+
+    all_parser = subparsers.add_parser("all", parents=[topic_options, tts_options], help="Run every stage for each topic")
+    all_parser.add_argument("--stream-audio", action="store_true", help="Synthesize the narration while the story is still being generated instead of after it")
+    all_parser.add_argument("--metrics-dir", default=".", help="Where the run's metrics.json report and story_pipeline.prom textfile are written")
+    all_parser.set_defaults(handler=command_all)
+
+    batch_parser = subparsers.add_parser("batch", parents=[tts_options], help="Queue stories from a JSONL file and run them in worker processes")
+    batch_parser.add_argument("input", nargs="?", help='JSONL, one {"topic", "world_details", "audience", "options"} per line; leave out to continue the queue in --db')
+    batch_parser.add_argument("--db", default="batch.sqlite", help="Job queue database, safe to reuse across runs and restarts")
+    batch_parser.add_argument("--workers", type=int, default=2, help="Worker processes, each running one story at a time")
+    batch_parser.add_argument("--max-attempts", type=int, default=3)
+    batch_parser.add_argument("--retry-delay", type=float, default=60, help="Seconds before a failed job's first retry, doubling after that")
+    batch_parser.add_argument("--metrics-dir", default=".", help="Where each worker writes metrics_worker_N.json")
+    batch_parser.add_argument("--status", action="store_true", help="List the jobs in --db with status, attempts and output or last error, and exit")
+    batch_parser.add_argument("--json", action="store_true", help="Print the throughput summary as JSON")
+    batch_parser.set_defaults(handler=command_batch)
+
+    bulk_parser = subparsers.add_parser("bulk", help="Write summaries and intros for many stories through one Batch API job")
+    bulk_parser.add_argument("--stories", nargs="*", help="Story folders to summarize (default: every folder here with a finished story)")
+    bulk_parser.add_argument("--intros", metavar="JOBS_FILE", help="Also write the intros for the topics in a batch JSONL file before their stories are generated")
+    bulk_parser.add_argument("--images", type=int, default=0, help="Images per story to generate from the summaries afterwards (no batch endpoint, so these are direct calls)")
+    bulk_parser.add_argument("--poll-seconds", type=float, default=60)
+    bulk_parser.add_argument("--timeout", type=float, help="Stop polling after this many seconds; run the command again to collect the batch")
+    bulk_parser.add_argument("--state-dir", default=".", help="Where the batch input file and the submitted batch's state are kept")
+    bulk_parser.set_defaults(handler=command_bulk)
+
+    serve_parser = subparsers.add_parser("serve", parents=[tts_options], help="Run as a daemon that takes story jobs over a local HTTP API")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--db", default="daemon.sqlite", help="Job queue database; jobs left running by a previous daemon are picked up again")
+    serve_parser.add_argument("--story-workers", type=int, default=4, help="Stories run at once")
+    serve_parser.add_argument("--stage-limit", action="append", default=[], metavar="STAGE=N", help="Most runs of a stage at once across all stories, e.g. video=1 (defaults: images=2, audio=2, video=1)")
+    serve_parser.add_argument("--retry-delay", type=float, default=60, help="Seconds before a failed job's first retry, doubling after that")
+    serve_parser.set_defaults(handler=command_serve)
+
+    plan_parser = subparsers.add_parser("plan", parents=[topic_options], help="Estimate segments, tokens, cost and run time without calling the API")
+    plan_parser.add_argument("--history", nargs="*", help="metrics.json reports of earlier runs to take latencies from (default: <metrics-dir>/metrics.json)")
+    plan_parser.add_argument("--metrics-dir", default=".")
+    plan_parser.add_argument("--image-count", type=int, default=4)
+    plan_parser.add_argument("--json", action="store_true", help="Print the plan as JSON")
+    plan_parser.set_defaults(handler=command_plan)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Set up logging configuration for script message logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    config = load_config(getattr(args, "config", None), getattr(args, "topics", None), getattr(args, "world", None), getattr(args, "audience", None),
+                         getattr(args, "total_token_limit", None), getattr(args, "max_tokens_per_call", None))
+    try:
+        # A handler returns its exit status, or nothing when it succeeded
+        return args.handler(args, config) or 0
+    except ValueError as e:
+        # e.g. no OPENAI_API_KEY for a command that calls the API
+        logging.error(str(e))
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from batch_runner import parse_job, run_job
+from job_queue import JobQueue, worker_name
+from pipeline import StageLimiter
+
+# Long-running story service: `python cli.py serve`. One process keeps the OpenAI client and its connection pool,
+# the stage modules, pydub and Pillow loaded, and takes story jobs over a local HTTP API:
+#   POST /jobs          {"topic": "...", "world_details": "...", "audience": "all", "options": {...}} -> 201 with the job,
+#                       or 409 with the existing job when the topic's story folder already has one
+#   GET  /jobs          every job
+#   GET  /jobs/<id>     status, attempts, last error, finished stages and the output paths once done
+#   GET  /metrics       Prometheus text: queue depth, per-stage latency and limits, API calls and cost
+# Jobs live in the same SQLite queue as batch runs, so a restarted daemon picks up where the last one stopped.
+
+# Loaded at startup so the first job doesn't pay for them; missing ones are skipped
+WARM_MODULES = ("story_creation_main", "PIL.Image", "pydub")
+
+# Stages that contend for the API's image and speech limits or for CPU; the story stage is bounded by story_workers
+DEFAULT_STAGE_LIMITS = {"images": 2, "audio": 2, "video": 1}
+
+# Call and stage records the daemon's MetricsRecorder keeps; a story makes a few dozen calls
+DAEMON_MAX_RECORDS = 10000
+
+def warm_up(client):
+    for module in WARM_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logging.warning(f"Could not preload {module}: {e}")
+    # Opens the first pooled connection now rather than on the first story
+    try:
+        client.models.list()
+    except Exception as e:
+        logging.info(f"Connection warm-up skipped: {e}")
+
+class StoryDaemon:
+    def __init__(self, client, recorder, job_queue, story_workers=4, stage_limits=None, retry_delay=60, heartbeat_seconds=30, tts_cache_dir=None, tts_requests_per_minute=None):
+        self.client = client
+        self.recorder = recorder
+        self.job_queue = job_queue
+        self.story_workers = story_workers
+        self.stage_limiter = StageLimiter(stage_limits or DEFAULT_STAGE_LIMITS)
+        self.retry_delay = retry_delay
+        self.heartbeat_seconds = heartbeat_seconds
+        self.tts_cache_dir = tts_cache_dir
+        self.tts_requests_per_minute = tts_requests_per_minute
+        self.worker = worker_name()
+        self.lock = threading.Lock()
+        self.active = {}  # job id -> that job's stage timings, filled in as stages finish
+        # Bumped on every submission; a worker that found the queue empty waits for it to change
+        self.submitted = threading.Condition()
+        self.submissions = 0
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        # Jobs a previous daemon or batch worker was running when it died go back in the queue first
+        self.job_queue.requeue_abandoned()
+        for index in range(1, self.story_workers + 1):
+            self.threads.append(threading.Thread(target=self._work, name=f"story-worker-{index}", daemon=True))
+        self.threads.append(threading.Thread(target=self._beat, name="heartbeat", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        # Running jobs go back to the queue for the next start; their manifests keep the finished work
+        self.stopping.set()
+        with self.submitted:
+            self.submitted.notify_all()
+        with self.lock:
+            running = list(self.active)
+        for job_id in running:
+            self.job_queue.release(job_id)
+        if running:
+            logging.info(f"Stopped with {len(running)} jobs running, they are back in the queue")
+
+    def submit(self, spec, max_attempts=3):
+        job, created = self.job_queue.add_job(parse_job(spec), max_attempts=max_attempts)
+        with self.submitted:
+            self.submissions += 1
+            self.submitted.notify_all()
+        return job, created
+
+    def job_status(self, job_id):
+        job = self.job_queue.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            timings = dict(self.active.get(job_id, {}))
+        if timings:
+            job["stages"] = {name: {"status": timing.status, "seconds": round(timing.duration, 3)} for name, timing in timings.items()}
+        return job
+
+    def _work(self):
+        while not self.stopping.is_set():
+            seen = self.submissions
+            job = self.job_queue.claim(self.worker)
+            if job is None:
+                # Wait for a submission, or for a retry delay to run out
+                next_available = self.job_queue.next_available()
+                timeout = self.heartbeat_seconds if next_available is None else min(max(next_available - time.time(), 0.1), self.heartbeat_seconds)
+                with self.submitted:
+                    self.submitted.wait_for(lambda: self.submissions != seen or self.stopping.is_set(), timeout)
+                continue
+            timings = {}
+            with self.lock:
+                self.active[job["id"]] = timings
+            logging.info(f"Started job {job['id']} '{job['topic']}' (attempt {job['attempts']} of {job['max_attempts']})")
+            try:
+                outputs = run_job(self.client, self.recorder, job, stage_limiter=self.stage_limiter, timings=timings, tts_cache_dir=self.tts_cache_dir,
+                                  tts_requests_per_minute=self.tts_requests_per_minute)
+            except Exception as e:
+                if not self.stopping.is_set():
+                    status = self.job_queue.fail(job["id"], e, self.retry_delay)
+                    logging.error(f"Job {job['id']} '{job['topic']}' failed: {e}; {status}")
+            else:
+                self.job_queue.complete(job["id"], outputs, cost=self.recorder.pop_story_cost(job["topic"]))
+                logging.info(f"Job {job['id']} '{job['topic']}' done, video at {outputs.get('video')}")
+            with self.lock:
+                self.active.pop(job["id"], None)
+
+    def _beat(self):
+        while not self.stopping.wait(self.heartbeat_seconds):
+            with self.lock:
+                running = list(self.active)
+            for job_id in running:
+                self.job_queue.heartbeat(job_id)
+
+    def metrics_text(self, prefix="story_pipeline"):
+        lines = [f"# TYPE {prefix}_jobs gauge"]
+        lines += [f'{prefix}_jobs{{status="{status}"}} {count}' for status, count in self.job_queue.counts().items()]
+        limits = self.stage_limiter.snapshot()
+        for name, metric_type in (("stage_limit", "gauge"), ("stage_running", "gauge"), ("stage_waiting", "gauge"), ("stage_wait_seconds_total", "counter")):
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            field = name.replace("stage_", "").replace("_total", "")
+            lines += [f'{prefix}_{name}{{stage="{stage}"}} {values[field]:g}' for stage, values in sorted(limits.items())]
+        return "\n".join(lines) + "\n" + self.recorder.prometheus_text(prefix, per_story=False)
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    daemon = None  # Set on the subclass make_server builds
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": f"No such endpoint: {self.path}"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job, created = self.daemon.submit(json.loads(self.rfile.read(length) or b"{}"))
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+        if not created:
+            # Queued, running or finished, the story folder is taken; its job says which
+            return self._send_json(409, {"error": f"'{job['topic']}' already has job {job['id']} ({job['status']})", "job": job})
+        self._send_json(201, job)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        match = re.fullmatch(r"/jobs/(\d+)", path)
+        if path == "/jobs":
+            self._send_json(200, self.daemon.job_queue.jobs())
+        elif match:
+            job = self.daemon.job_status(int(match.group(1)))
+            if job is None:
+                return self._send_json(404, {"error": f"No job {match.group(1)}"})
+            self._send_json(200, job)
+        elif path == "/metrics":
+            self._send(200, self.daemon.metrics_text().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"No such endpoint: {self.path}"})
+
+    def _send_json(self, status, body):
+        self._send(status, json.dumps(body, indent=2).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+def make_server(daemon, host="127.0.0.1", port=8765):
+    handler = type("StoryJobHandler", (JobRequestHandler,), {"daemon": daemon})
+    return ThreadingHTTPServer((host, port), handler)
+
+def serve(client, recorder, db_path="daemon.sqlite", host="127.0.0.1", port=8765, story_workers=4, stage_limits=None, retry_delay=60, tts_cache_dir=None, tts_requests_per_minute=None):
+    # No authentication: keep it on localhost, or behind something that adds it
+    warm_up(client)
+    daemon = StoryDaemon(client, recorder, JobQueue(db_path), story_workers=story_workers, stage_limits=stage_limits, retry_delay=retry_delay,
+                         tts_cache_dir=tts_cache_dir, tts_requests_per_minute=tts_requests_per_minute)
+    daemon.start()
+    server = make_server(daemon, host, port)
+    logging.info(f"Story daemon listening on http://{host}:{port} with {story_workers} story workers, stage limits {daemon.stage_limiter.limits}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+    # Exit without waiting for the stage threads still running: their jobs were just handed back, and the next
+    # start resumes them from their manifests, which are only ever replaced whole
+    logging.shutdown()
+    os._exit(0)
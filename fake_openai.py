@@ -0,0 +1,337 @@
+import base64
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from types import SimpleNamespace
+
+import mp3_frames
+
+# Local stand-in for the OpenAI client: same call shapes as chat.completions.create, audio.speech.create,
+# images.generate and the Batch API (files.create/content, batches.create/retrieve), with deterministic output,
+# configurable latency, throughput limits and injected 429/5xx errors.
+# Pass a FakeOpenAI wherever a client is expected to benchmark or exercise the pipeline without spending money.
+
+WORDS = ("the island ancient tide whispered lantern stone harbor secret map storm captain temple silver "
+         "shadow voice door light ocean ruins key crown memory glass song wind fire bridge garden").split()
+
+class FakeAPIError(Exception):
+    # Carries status_code like openai.APIStatusError, so retry code can treat both the same way
+    def __init__(self, message, status_code, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class FakeRateLimitError(FakeAPIError):
+    def __init__(self, message="Rate limit reached", retry_after=1.0):
+        super().__init__(message, 429, {"retry-after": f"{retry_after:.2f}"})
+
+class FakeServerError(FakeAPIError):
+    def __init__(self, message="The server had an error while processing your request", status_code=500):
+        super().__init__(message, status_code)
+
+# Automatic prompt caching as the API does it: prompts of at least 1024 tokens reuse the longest prefix seen
+# before, in steps of 128 tokens. The fake counts 4 characters per token.
+PREFIX_CACHE_MIN_CHARS = 1024 * 4
+PREFIX_CACHE_STEP_CHARS = 128 * 4
+
+class Latency:
+    # Sampled seconds per call: "fixed" (value), "uniform" (low, high) or "lognormal" (median, sigma)
+    def __init__(self, kind="lognormal", *params, per_unit=0.0):
+        self.kind = kind
+        self.params = params
+        self.per_unit = per_unit  # Extra seconds per output token or input character
+
+    def sample(self, rng, units=0):
+        if self.kind == "fixed":
+            base = self.params[0]
+        elif self.kind == "uniform":
+            base = rng.uniform(*self.params)
+        else:
+            median, sigma = self.params
+            base = rng.lognormvariate(0, sigma) * median
+        return base + self.per_unit * units
+
+DEFAULT_LATENCY = {
+    "chat": Latency("lognormal", 0.8, 0.4, per_unit=0.012),
+    "speech": Latency("lognormal", 1.5, 0.3, per_unit=0.0008),
+    "images": Latency("lognormal", 12.0, 0.25),
+}
+
+class Endpoint:
+    def __init__(self, name, latency, max_concurrent=None, requests_per_minute=None, rate_limit_error_rate=0.0, server_error_rate=0.0):
+        self.name = name
+        self.latency = latency
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.requests_per_minute = requests_per_minute
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.server_error_rate = server_error_rate
+        self.started = deque()
+        self.lock = threading.Lock()
+
+class FakeOpenAI:
+    def __init__(self, seed=0, latency=None, latency_scale=1.0, max_concurrent=None, requests_per_minute=None,
+                 rate_limit_error_rate=0.0, server_error_rate=0.0, completion_tokens=700, batch_seconds=30.0):
+        # Every limit and error rate is either one value for all endpoints or a dict keyed by "chat", "speech", "images"
+        def per_endpoint(value, name):
+            return value.get(name) if isinstance(value, dict) else value
+
+        latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.endpoints = {
+            name: Endpoint(name, latency[name], per_endpoint(max_concurrent, name), per_endpoint(requests_per_minute, name),
+                           per_endpoint(rate_limit_error_rate, name) or 0.0, per_endpoint(server_error_rate, name) or 0.0)
+            for name in ("chat", "speech", "images")
+        }
+        self.latency_scale = latency_scale
+        self.completion_tokens = completion_tokens
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.calls_lock = threading.Lock()
+        self.prefixes = set()
+        self.prefixes_lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(create=self._speech_create))
+        self.images = SimpleNamespace(generate=self._images_generate)
+        # A batch completes batch_seconds (times latency_scale) after it was created, on the first retrieve after that
+        self.batch_seconds = batch_seconds
+        self.files = SimpleNamespace(create=self._files_create, content=self._files_content)
+        self.batches = SimpleNamespace(create=self._batches_create, retrieve=self._batches_retrieve)
+        self.stored_files = {}
+        self.stored_batches = {}
+        self.batch_lock = threading.RLock()
+
+    def _call(self, name, units, produce):
+        endpoint = self.endpoints[name]
+        with self.calls_lock:
+            self.calls[name] += 1
+        with self.rng_lock:
+            roll = self.rng.random()
+            delay = endpoint.latency.sample(self.rng, units) * self.latency_scale
+        if endpoint.requests_per_minute:
+            with endpoint.lock:
+                now = time.monotonic()
+                while endpoint.started and now - endpoint.started[0] >= 60:
+                    endpoint.started.popleft()
+                if len(endpoint.started) >= endpoint.requests_per_minute:
+                    self._count_error(name)
+                    raise FakeRateLimitError(f"Rate limit reached for {name}: {endpoint.requests_per_minute} requests per min", 60 - (now - endpoint.started[0]))
+                endpoint.started.append(now)
+        if roll < endpoint.rate_limit_error_rate:
+            self._count_error(name)
+            raise FakeRateLimitError(f"Injected rate limit error for {name}")
+        if roll < endpoint.rate_limit_error_rate + endpoint.server_error_rate:
+            self._count_error(name)
+            raise FakeServerError(f"Injected server error for {name}", status_code=503)
+        if endpoint.slots:
+            endpoint.slots.acquire()
+        try:
+            time.sleep(delay)
+            return produce()
+        finally:
+            if endpoint.slots:
+                endpoint.slots.release()
+
+    def _cached_chars(self, prompt):
+        if len(prompt) < PREFIX_CACHE_MIN_CHARS:
+            return 0
+        digest = hashlib.sha256()
+        cached = 0
+        start = 0
+        with self.prefixes_lock:
+            for end in range(PREFIX_CACHE_MIN_CHARS, len(prompt) + 1, PREFIX_CACHE_STEP_CHARS):
+                digest.update(prompt[start:end].encode("utf-8"))
+                start = end
+                key = digest.copy().digest()
+                if key in self.prefixes:
+                    cached = end
+                else:
+                    self.prefixes.add(key)
+        return cached
+
+    def _count_error(self, name):
+        with self.calls_lock:
+            self.errors[name] += 1
+
+    def _chat_create(self, messages, model, max_tokens=None, stream=False, stream_options=None, response_format=None, **kwargs):
+        content, usage = self._chat_completion(messages, max_tokens, response_format)
+        if stream:
+            return self._call("chat", 0, lambda: FakeStream(content, usage if stream_options and stream_options.get("include_usage") else None, self.latency_scale))
+        message = SimpleNamespace(role="assistant", content=content)
+        return self._call("chat", usage.completion_tokens, lambda: SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage, model=model))
+
+    def _chat_completion(self, messages, max_tokens=None, response_format=None):
+        prompt = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        completion_tokens = min(max_tokens or self.completion_tokens, self.completion_tokens)
+        if response_format and response_format.get("type") == "json_object":
+            content = json.dumps({"summary": fake_text(seed, 80), "characters": ["Mara: the captain"], "plot_threads": ["The missing map"]})
+        else:
+            content = fake_text(seed, completion_tokens)
+            if "end markers" in prompt:
+                # generate_story only offers the end markers near the end of its budget, so finish there
+                content += "\n\nThe End"
+        prompt_tokens = len(prompt) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=self._cached_chars(prompt) // 4),
+        )
+        return content, usage
+
+    def _speech_create(self, model, voice, input, response_format="mp3", **kwargs):
+        # About 15 characters of narration per second, as silent frames in tts-1's 24 kHz mono format
+        duration_ms = max(1000, len(input) * 1000 // 15)
+        return self._call("speech", len(input), lambda: FakeBinaryResponse(mp3_frames.silence(2.0, 160000, 24000, 1, duration_ms)))
+
+    def _images_generate(self, model, prompt, size="1024x1024", n=1, response_format="url", **kwargs):
+        width, height = (int(value) for value in size.split("x"))
+        color = hashlib.sha256(prompt.encode("utf-8")).digest()[:3]
+        image_b64 = base64.b64encode(png_bytes(width, height, color)).decode("ascii")
+
+        def produce():
+            images = [SimpleNamespace(b64_json=image_b64 if response_format == "b64_json" else None, url=None, revised_prompt=prompt) for _ in range(n)]
+            return SimpleNamespace(data=images, created=int(time.time()))
+        return self._call("images", 0, produce)
+
+    def _files_create(self, file, purpose):
+        # file is an open binary file, as the SDK takes it, or a (name, bytes) tuple
+        name, content = file if isinstance(file, tuple) else (getattr(file, "name", "upload.jsonl"), file.read())
+        return self._store_file(str(name), content, purpose)
+
+    def _store_file(self, name, content, purpose):
+        with self.batch_lock:
+            file_id = f"file-{len(self.stored_files) + 1}"
+            self.stored_files[file_id] = content
+        return SimpleNamespace(id=file_id, filename=name, bytes=len(content), purpose=purpose)
+
+    def _files_content(self, file_id):
+        if file_id not in self.stored_files:
+            raise FakeAPIError(f"No such File object: {file_id}", 404)
+        return FakeBinaryResponse(self.stored_files[file_id])
+
+    def _batches_create(self, input_file_id, endpoint, completion_window, metadata=None, **kwargs):
+        if input_file_id not in self.stored_files:
+            raise FakeAPIError(f"No such File object: {input_file_id}", 404)
+        if endpoint != "/v1/chat/completions":
+            raise FakeAPIError(f"The fake only runs /v1/chat/completions batches, not {endpoint}", 400)
+        lines = [line for line in self.stored_files[input_file_id].decode("utf-8").splitlines() if line.strip()]
+        with self.batch_lock:
+            batch_id = f"batch_{len(self.stored_batches) + 1}"
+            batch = SimpleNamespace(id=batch_id, status="validating", endpoint=endpoint, input_file_id=input_file_id,
+                                    completion_window=completion_window, metadata=metadata, created_at=time.time(),
+                                    output_file_id=None, error_file_id=None,
+                                    request_counts=SimpleNamespace(total=len(lines), completed=0, failed=0))
+            self.stored_batches[batch_id] = batch
+        return batch
+
+    def _batches_retrieve(self, batch_id):
+        batch = self.stored_batches.get(batch_id)
+        if batch is None:
+            raise FakeAPIError(f"No such Batch object: {batch_id}", 404)
+        with self.batch_lock:
+            if batch.status in ("validating", "in_progress"):
+                if time.time() - batch.created_at >= self.batch_seconds * self.latency_scale:
+                    self._run_batch(batch)
+                else:
+                    batch.status = "in_progress"
+        return batch
+
+    def _run_batch(self, batch):
+        # Each line is answered like a chat call, without the per-call latency; injected errors become error lines
+        endpoint = self.endpoints["chat"]
+        outputs, errors = [], []
+        for line in self.stored_files[batch.input_file_id].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = request["body"]
+            with self.rng_lock:
+                roll = self.rng.random()
+            if roll < endpoint.rate_limit_error_rate + endpoint.server_error_rate:
+                errors.append({"id": f"{batch.id}-{len(errors)}", "custom_id": request["custom_id"], "error": None,
+                               "response": {"status_code": 500, "body": {"error": {"message": "Injected server error for batch request"}}}})
+                continue
+            content, usage = self._chat_completion(body["messages"], body.get("max_tokens"), body.get("response_format"))
+            response_body = {
+                "object": "chat.completion", "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens,
+                          "prompt_tokens_details": {"cached_tokens": usage.prompt_tokens_details.cached_tokens}},
+            }
+            outputs.append({"id": f"{batch.id}-{len(outputs)}", "custom_id": request["custom_id"], "error": None,
+                            "response": {"status_code": 200, "body": response_body}})
+        with self.calls_lock:
+            self.calls["batch"] += len(outputs) + len(errors)
+        batch.output_file_id = self._store_file(f"{batch.id}_output.jsonl", "".join(json.dumps(line) + "\n" for line in outputs).encode("utf-8"), "batch_output").id if outputs else None
+        batch.error_file_id = self._store_file(f"{batch.id}_errors.jsonl", "".join(json.dumps(line) + "\n" for line in errors).encode("utf-8"), "batch_output").id if errors else None
+        batch.request_counts = SimpleNamespace(total=len(outputs) + len(errors), completed=len(outputs), failed=len(errors))
+        batch.status = "completed"
+
+class FakeStream:
+    # Iterates chat completion chunks the way the SDK's Stream does and supports close()
+    def __init__(self, content, usage, latency_scale):
+        self.content = content
+        self.usage = usage
+        self.latency_scale = latency_scale
+        self.closed = False
+
+    def __iter__(self):
+        for word in self.content.split(" "):
+            if self.closed:
+                return
+            time.sleep(0.01 * self.latency_scale)
+            delta = SimpleNamespace(content=word + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        if self.usage is not None:
+            yield SimpleNamespace(choices=[], usage=self.usage)
+
+    def close(self):
+        self.closed = True
+
+class FakeBinaryResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+def fake_text(seed, token_count):
+    # Deterministic paragraphs of roughly token_count tokens, with sentence breaks for the segmenter to find
+    rng = random.Random(seed)
+    paragraphs = []
+    words_left = max(1, int(token_count * 0.75))
+    while words_left > 0:
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            length = min(words_left, rng.randint(8, 18))
+            if length <= 0:
+                break
+            words = [rng.choice(WORDS) for _ in range(length)]
+            sentences.append(" ".join(words).capitalize() + ".")
+            words_left -= length
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+_png_cache = {}
+
+def png_bytes(width, height, color):
+    # Minimal valid RGB PNG filled with one color
+    key = (width, height, bytes(color))
+    if key not in _png_cache:
+        def chunk(tag, data):
+            return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        row = b"\x00" + bytes(color) * width
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        _png_cache[key] = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b"")
+    return _png_cache[key]
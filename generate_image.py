@@ -1,16 +1,28 @@
-import openai
-import os
-import requests
-from PIL import Image
-from io import BytesIO
+import base64
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+THUMBNAIL_SIZE = (1280, 720)
 
-if openai.api_key is None:
-    raise ValueError("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
+_session = None
+_session_lock = threading.Lock()
 
-TOKEN_COST_PER_MILLION = 15 / 1_000_000
-DALL_E_COST_PER_IMAGE = 0.02
+def get_session():
+    # One pooled session for all downloads so repeated saves reuse the TLS connection
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests loads on the first download rather than at import, to keep startup fast
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
 
 def read_story(file_path):
     with open(file_path, "r", encoding='utf-8') as file:
@@ -23,7 +35,8 @@ def create_prompt(summary):
             f"The style should be vibrant and eye-catching to attract viewers' attention. "
             f"Use colors and lighting that enhance the overall appeal and accurately convey the story's atmosphere.")
 
-def generate_image_from_summary(client, summary):
+def generate_image_from_summary(client, summary, response_format="url"):
+    # Returns the image URL, or the base64 PNG data when response_format is "b64_json"
     try:
         prompt = create_prompt(summary)
         
@@ -32,14 +45,17 @@ def generate_image_from_summary(client, summary):
             prompt=prompt,
             size="1024x1024",
             quality="standard",
-            n=1
+            n=1,
+            response_format=response_format
         )
 
-        print("API Response:", response)
+        if response_format == "url":
+            print("API Response:", response)  # A base64 payload is far too large to print
 
         # Ensure the response data is correctly accessed
         if response and hasattr(response, 'data') and len(response.data) > 0:
-            image_url = response.data[0].url
+            image = response.data[0]
+            image_url = image.b64_json if response_format == "b64_json" else image.url
             return image_url, len(prompt)
         else:
             raise ValueError("No image URL found in the response")
@@ -47,13 +63,19 @@ def generate_image_from_summary(client, summary):
         print(f"An error occurred: {e}")
         return None, 0
 
-def save_image(url, save_path):
+def save_image(url, save_path, resize_to=None):
+    import requests
+
     try:
         if url:
-            response = requests.get(url)
-            response.raise_for_status()
-            img = Image.open(BytesIO(response.content))
-            img.save(save_path)
+            # Stream the download straight to disk through the pooled session
+            with get_session().get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(save_path, "wb") as image_file:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        image_file.write(chunk)
+            if resize_to:
+                resize_image(save_path, save_path, resize_to)
             print(f"Image saved to {save_path}")
         else:
             print("Invalid URL provided")
@@ -64,7 +86,43 @@ def save_image(url, save_path):
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
-def calculate_total_cost(token_count, dall_e_cost_per_image, token_cost_per_million):
-    token_cost = (token_count / 1_000_000) * token_cost_per_million
-    total_cost = token_cost + dall_e_cost_per_image
-    return total_cost
+def save_image_bytes(image_data, save_path, resize_to=None):
+    with open(save_path, "wb") as image_file:
+        image_file.write(image_data)
+    if resize_to:
+        resize_image(save_path, save_path, resize_to)
+
+def resize_image(source_path, save_path, size):
+    # Only resizing or format conversion needs the PIL decode/encode round trip
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as img:
+        resized = ImageOps.fit(img.convert("RGB"), size, Image.LANCZOS)
+    resized.save(save_path)
+
+def thumbnail_path(image_path):
+    image_path = Path(image_path)
+    return image_path.with_name(f"{image_path.stem}_thumb{image_path.suffix}")
+
+def generate_images_from_summary(client, summary, save_paths, max_workers=4, thumbnail_size=None):
+    # dall-e-3 only returns one image per call, so the calls run side by side and each saves its own base64 payload.
+    # A failure is logged and gives None for that image only, so the images that were paid for still get returned
+    def generate(save_path):
+        image_b64, _ = generate_image_from_summary(client, summary, response_format="b64_json")
+        if not image_b64:
+            return None
+        try:
+            save_image_bytes(base64.b64decode(image_b64), save_path)
+        except Exception as e:
+            logging.error(f"Could not save the image to {save_path}: {e}")
+            return None
+        logging.info(f"Image saved to {save_path}")
+        if thumbnail_size:
+            # The image itself is fine without its thumbnail; the video falls back to a black frame
+            try:
+                resize_image(save_path, thumbnail_path(save_path), thumbnail_size)
+            except Exception as e:
+                logging.error(f"Could not make a thumbnail of {save_path}: {e}")
+        return save_path
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(generate, save_paths))
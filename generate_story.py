@@ -2,42 +2,165 @@ import os
 import logging
 import time
 import re
-from openai import OpenAI
+from openai_client import get_client
+from story_context import StoryContext
+from run_manifest import load_manifest, content_hash, file_hash
+from metrics import instrument
+from token_counter import count_tokens
+
+# Prompts are laid out for the provider's automatic prefix caching: instructions that never change go first in a
+# system message, then what is fixed for one story, then the story so far, and the numbers that change on every
+# call (completion percentage, remaining tokens) come last, so consecutive calls share the longest possible prefix.
+STORY_SYSTEM_PROMPT = """
+You are a master storyteller with a gift for captivating narratives. Ensure the story builds elements of mystery, adventure, has a surprising twist, is appropriate content and engaging for the audience named below. Your style resembles that of renowned modern literary works.
+
+Continue the story you are given, maintaining engagement and emotional depth, avoiding repetition of themes. Create chapters thoughtfully, only when a story section naturally concludes, and provide each chapter with a unique and intriguing title.
+
+Review the existing story so far, noting themes covered, pacing, and direction to ensure the continuation aligns seamlessly with the established style and format. Reviewing the story provided thus far and noting key details, build upon the previous segment, preserving coherence and continuity while balancing narrative progression with consideration of your segments position in the story timeline.
+"""
+
+INTRO_SYSTEM_PROMPT = """
+You are an expert storyteller. Provide a brief, engaging introduction to the story you are given.
+This introduction should be from the presenter's perspective, sharing their thoughts on the story and what the audience can expect without giving away major plot points.
+The intro should be intriguing and set the tone for the story, no more than 3 or 4 sentences, making the listeners excited to hear more. Don't use "Ladies and Gentelemen" use "all", and avoid cut off sentences.
+"""
+
+SUMMARY_SYSTEM_PROMPT = "Provide a concise summary of the following story."
+
+END_MARKERS = ["<END OF STORY>", "The End"]
+# Characters that close an end marker written as a phrase, e.g. "The End." or "**The End**", or "The End" on a line
+# of its own before an afterword
+MARKER_CLOSERS = r"[.!?\u2026*_\"'\u201d\u2019)\]\n]"
+STORY_ENDING = "\n\nThat is the end of our story today, thank you so much for listening. Please, let me know your thoughts, and be well my friends."
+
+def end_marker_pattern(markers, at_end_of_text=True):
+    # A marker that starts or ends with a letter only counts as a whole phrase followed by punctuation, a line break
+    # or the end of the text: "The End." stops the story, "The Endless Sea" does not. Streamed text has no end yet,
+    # since the next delta may still turn "The End" into "The Endless", so there only punctuation and line breaks count.
+    # Any case matches ("THE END."), except a lowercase first letter, so prose like "to the end." keeps going
+    closer = rf"(?=\s*(?:{MARKER_CLOSERS}|$))" if at_end_of_text else rf"(?=\s*{MARKER_CLOSERS})"
+    alternatives = []
+    for marker in markers:
+        pattern = re.escape(marker)
+        if marker[:1].isalpha():
+            pattern = rf"(?-i:{marker[0].upper()}){re.escape(marker[1:])}"
+        if marker[:1].isalnum():
+            pattern = r"(?<!\w)" + pattern
+        if marker[-1:].isalnum():
+            pattern += closer
+        alternatives.append(pattern)
+    return re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+def has_end_marker(text, markers):
+    pattern = end_marker_pattern(markers)
+    return pattern is not None and pattern.search(text) is not None
 
 def setup_openai_client(api_key: str):
-    return OpenAI(api_key=api_key)
+    return get_client(api_key)
+
+def build_messages(prompt, system_prompt=None):
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.append({"role": "user", "content": prompt})
+    return messages
 
-def generate_story_segment(client, prompt: str, max_tokens: int = 4095):
+def log_usage(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    logging.info(f"Prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached), completion tokens: {usage.completion_tokens}")
+
+def generate_story_segment(client, prompt: str, max_tokens: int = 4095, stream: bool = False, stream_path=None, stop_markers=None, system_prompt=None):
+    if stream:
+        return stream_story_segment(client, prompt, max_tokens, stream_path, stop_markers, system_prompt)
     try:
         start_time = time.time()
         chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
+            messages=build_messages(prompt, system_prompt),
             model="gpt-4o",
             max_tokens=max_tokens
         )
         end_time = time.time()
         time_taken = end_time - start_time
         tokens_used = chat_completion.usage.total_tokens
+        log_usage(chat_completion.usage)
         return chat_completion.choices[0].message.content, tokens_used, time_taken
     except Exception as e:
+        # The client has already retried; let the caller stop here so --resume can pick up from this segment
         logging.error(f"Error during API call: {e}")
-        return "", 0, 0
+        raise
 
-def generate_intro(client, story_topic: str, world_details: str, max_tokens: int = 500):
+def stream_story_segment(client, prompt: str, max_tokens: int = 4095, stream_path=None, stop_markers=None, system_prompt=None):
+    # Same return contract as generate_story_segment, but appends deltas to stream_path as they arrive
+    # and hangs up as soon as a stop marker appears so the tokens after it are never generated
+    stop_pattern = end_marker_pattern(stop_markers or [], at_end_of_text=False)
+    # Room for the marker, the character before it and the whitespace and punctuation after it
+    marker_window = max((len(marker) for marker in stop_markers or []), default=0) + 16
+    parts = []
+    tail = ""
+    usage = None
+    first_token_time = None
     try:
-        intro_prompt = f"""
-        You are an expert storyteller. Provide a brief, engaging introduction to the story titled '{story_topic}'.
-        This introduction should be from the presenter's perspective, sharing their thoughts on the story and what the audience can expect without giving away major plot points.
-        The intro should be intriguing and set the tone for the story, no more than 3 or 4 sentences, making the listeners excited to hear more. Don't use "Ladies and Gentelemen" use "all", and avoid cut off sentences.
+        start_time = time.time()
+        response_stream = client.chat.completions.create(
+            messages=build_messages(prompt, system_prompt),
+            model="gpt-4o",
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        stream_file = open(stream_path, "a", encoding="utf-8") if stream_path else None
+        try:
+            for chunk in response_stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if first_token_time is None:
+                    first_token_time = time.time()
+                parts.append(delta)
+                if stream_file:
+                    stream_file.write(delta)
+                    stream_file.flush()
+                # Only the last few characters can complete a marker that spans chunk boundaries
+                tail = (tail + delta)[-(marker_window + len(delta)):]
+                if stop_pattern is not None and stop_pattern.search(tail):
+                    logging.info("End marker streamed, closing the stream early.")
+                    break
+        finally:
+            response_stream.close()
+            if stream_file:
+                stream_file.close()
+        time_taken = time.time() - start_time
+    except Exception as e:
+        logging.error(f"Error during API call: {e}")
+        raise
+
+    content = "".join(parts)
+    if usage:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        log_usage(usage)
+    else:
+        # The usage chunk only comes at the very end; after an early stop, count one token per content delta
+        prompt_tokens, completion_tokens = (len(prompt) + len(system_prompt or "")) // 4, len(parts)
+        logging.info("Stream stopped before usage was reported, token counts are estimates.")
+        logging.info(f"Prompt tokens: {prompt_tokens}, completion tokens: {completion_tokens}")
+    if first_token_time is not None:
+        time_to_first_token = first_token_time - start_time
+        generation_time = max(time.time() - first_token_time, 1e-9)
+        logging.info(f"Time to first token: {time_to_first_token:.2f} seconds, {completion_tokens / generation_time:.1f} tokens/sec")
+    return content, prompt_tokens + completion_tokens, time_taken
+
+def build_intro_prompt(story_topic, world_details):
+    return f"""
+        Story title: '{story_topic}'
 
         Initial World Details: {world_details}
         """
-        intro_content, tokens_used, time_taken = generate_story_segment(client, intro_prompt, max_tokens)
+
+def generate_intro(client, story_topic: str, world_details: str, max_tokens: int = 500):
+    try:
+        intro_prompt = build_intro_prompt(story_topic, world_details)
+        intro_content, tokens_used, time_taken = generate_story_segment(client, intro_prompt, max_tokens, system_prompt=INTRO_SYSTEM_PROMPT)
         if not intro_content.strip():
             logging.error("Intro generation failed, no content returned.")
             return "", 0, 0
@@ -49,6 +172,9 @@ def generate_intro(client, story_topic: str, world_details: str, max_tokens: int
 def sanitize_filename(filename: str) -> str:
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
+def story_folder(story_topic: str) -> str:
+    return story_topic.replace(' ', '_').lower()
+
 def save_story_to_file(story: str, foldername: str, filename: str):
     if not os.path.exists(foldername):
         os.makedirs(foldername)
@@ -62,73 +188,177 @@ def save_story_to_file(story: str, foldername: str, filename: str):
     logging.info(f"Story generated and saved to {filepath}")
     return filepath
 
-def generate_story(api_key, story_topics, world_details, intended_audience, max_tokens_per_call=4095, total_token_limit=10000):
-    client = setup_openai_client(api_key)
+class ParagraphFeed:
+    # Puts each finished paragraph of the story on a queue while it is being written, for text-to-speech to start early.
+    # The text passed to add() is the same text appended to the story, so the last paragraph of a segment is held
+    # back until the next segment shows whether it continues.
+    def __init__(self, paragraph_queue):
+        self.queue = paragraph_queue
+        self.tail = ""
+
+    def add(self, text):
+        if self.queue is None:
+            return
+        paragraphs = (self.tail + text).split("\n\n")
+        self.tail = paragraphs.pop()
+        for paragraph in paragraphs:
+            if paragraph.strip():
+                self.queue.put(paragraph.strip())
+
+    def flush(self):
+        if self.queue is not None and self.tail.strip():
+            self.queue.put(self.tail.strip())
+        self.tail = ""
+
+def build_story_prompt(story_topic, audience, world_detail, story_so_far, story_completion_percentage, remaining_tokens, end_markers):
+    # Stable for the whole story first, then the story so far, then this call's progress numbers
+    prompt = f"""
+            Story title: '{story_topic}'
+            Audience: {audience}
+
+            Initial World Details(which may have changed, review the story): {world_detail}
+
+            Current Story:
+            {story_so_far}
+
+            The story is approximately {story_completion_percentage:.2f}% complete. You have approximately {remaining_tokens} tokens remaining to conclude the narrative.
+            """
+
+    if story_completion_percentage >= 80:
+        prompt += f"\nIf the story is past 90% complete, you may conclude the story with an epilogue if you see fit, and mark the end of the story with one of the following end markers: {end_markers}.\n"
+    prompt += "\nContinue the story from here.\n"
+    return prompt
 
-    token_cost_per_million = 15 / 1_000_000
-    end_markers = ["<END OF STORY>", "The End"]
+def generate_story(api_key, story_topics, world_details, intended_audience, max_tokens_per_call=4095, total_token_limit=10000, recent_paragraphs=8, stream=False, resume=False, client=None, paragraph_queue=None):
+    # With paragraph_queue, finished paragraphs (title and intro first) are put on it as they are written;
+    # whoever owns the queue signals the end of the story (see text_to_audio.iter_paragraph_queue)
+    client = client or setup_openai_client(api_key)
+
+    end_markers = END_MARKERS
 
     generated_story_paths = []
     total_cost = 0
 
     for story_topic in story_topics:
+        # Every call for this story is recorded and priced under its own label
+        story_client = instrument(client, story=story_topic, stage="story")
         current_story = ""
+        context = StoryContext(story_client, recent_paragraphs=recent_paragraphs)
         total_tokens_used = 0
+        # The budget is the story's own length, counted locally, so prompt tokens (which grow with the context) don't eat into it
+        story_tokens = 0
         total_time_taken = 0
         world_detail = world_details.get(story_topic, "")
         audience = intended_audience
 
-        while total_tokens_used < total_token_limit:
-            remaining_tokens = total_token_limit - total_tokens_used
-            is_final_segment = remaining_tokens <= max_tokens_per_call
-            story_completion_percentage = (total_tokens_used / total_token_limit) * 100
+        feed = ParagraphFeed(paragraph_queue)
 
-            prompt = f"""
-            You are a master storyteller with a gift for captivating narratives. Ensure the story builds elements of mystery, adventure, has a surprising twist, is appropriate content and engaging for a {audience} audience. Your style resembles that of renowned modern literary works.
+        foldername = story_folder(story_topic)
+        filepath = os.path.join(foldername, sanitize_filename(f"{foldername}.txt"))
+        manifest = load_manifest(foldername)
+        if not resume:
+            # An intro written ahead of time in bulk (bulk_requests.py) for the same topic and world details is kept
+            prewritten_intro = manifest.get("story/intro")
+            manifest.reset()
+            if prewritten_intro and prewritten_intro.get("prompt_hash") == content_hash(build_intro_prompt(story_topic, world_detail)):
+                manifest.record("story/intro", prewritten_intro["hash"], text=prewritten_intro["text"], prompt_hash=prewritten_intro["prompt_hash"])
+        elif os.path.exists(filepath) and manifest.is_done("story", file_hash(filepath)):
+            logging.info(f"Story already complete, skipping generation: {filepath}")
+            with open(filepath, "r", encoding="utf-8") as story_file:
+                feed.add(story_file.read())
+            feed.flush()
+            generated_story_paths.append(filepath)
+            continue
 
-            Initial World Details(which may have changed, review the story): {world_detail}
+        # The intro only depends on the topic and world details, so it is written first and can be narrated first
+        intro_entry = manifest.get("story/intro")
+        if intro_entry:
+            intro_content = intro_entry["text"]
+        else:
+            intro_content, _, _ = generate_intro(story_client, story_topic, world_detail)
+            if intro_content:
+                manifest.record("story/intro", content_hash(intro_content), text=intro_content)
+        story_header = f"Today's story is called '{story_topic}'\n\n{intro_content}\n\n"
+        feed.add(story_header)
 
-            Continue the story titled '{story_topic}', maintaining engagement and emotional depth, avoiding repetition of themes. Create chapters thoughtfully, only when a story section naturally concludes, and provide each chapter with a unique and intriguing title.
+        # Replay the segments a previous run finished, then carry on from the first missing one
+        segment_number = 0
+        story_ended = False
+        while True:
+            entry = manifest.get(f"story/segment_{segment_number + 1}")
+            if entry is None:
+                break
+            segment_number += 1
+            current_story += " " + entry["text"]
+            feed.add(" " + entry["text"])
+            total_tokens_used += entry["tokens_used"]
+            story_tokens += count_tokens(entry["text"])
+            total_time_taken += entry["time_taken"]
+            context = StoryContext.from_dict(story_client, entry["context"])
+            story_ended = has_end_marker(entry["text"], end_markers)
+        if segment_number:
+            logging.info(f"Resuming '{story_topic}' after {segment_number} finished segments ({story_tokens} story tokens, {total_tokens_used} tokens used)")
 
-            The story is approximately {story_completion_percentage:.2f}% complete. You have approximately {total_token_limit - total_tokens_used} tokens remaining to conclude the narrative. Review the existing story so far, noting themes covered, pacing, and direction to ensure the continuation aligns seamlessly with the established style and format. Reviewing the story provided thus far and noting key details, build upon the previous segment, preserving coherence and continuity while balancing narrative progression with consideration of your segments position in the story timeline.
+        stream_path = None
+        if stream:
+            # Streamed deltas land here as they arrive; the finished story still goes to the usual file
+            os.makedirs(foldername, exist_ok=True)
+            stream_path = os.path.join(foldername, f"{sanitize_filename(foldername)}.partial.txt")
+            with open(stream_path, "w", encoding="utf-8") as stream_file:
+                stream_file.write(current_story)
 
-            Current Story:
-            {current_story}
+        while not story_ended and story_tokens < total_token_limit:
+            remaining_tokens = total_token_limit - story_tokens
+            is_final_segment = remaining_tokens <= max_tokens_per_call
+            story_completion_percentage = (story_tokens / total_token_limit) * 100
 
-            Continue the story from here.
-            """
+            prompt = build_story_prompt(story_topic, audience, world_detail, context.render(), story_completion_percentage, remaining_tokens, end_markers)
+
+            if stream_path:
+                with open(stream_path, "a", encoding="utf-8") as stream_file:
+                    stream_file.write(" ")
+            try:
+                segment_content, tokens_used, time_taken = generate_story_segment(story_client, prompt, min(max_tokens_per_call, remaining_tokens), stream=stream, stream_path=stream_path, stop_markers=end_markers, system_prompt=STORY_SYSTEM_PROMPT)
+            except Exception as e:
+                raise RuntimeError(f"Story generation for '{story_topic}' failed at segment {segment_number + 1} after retries, re-run with resume to continue") from e
 
-            if story_completion_percentage >= 80:
-                prompt += f"\nIf the story is past 90% complete, you may conclude the story with an epilogue if you see fit, and mark the end of the story with one of the following end markers: {end_markers}.\n"
-            
-            segment_content, tokens_used, time_taken = generate_story_segment(client, prompt, min(max_tokens_per_call, remaining_tokens))
-            
             if not segment_content.strip():
+                # Stop without saving a truncated story; the finished segments are in the manifest for --resume
                 logging.error("Story generation failed, no content returned.")
-                break
+                raise RuntimeError(f"Story generation for '{story_topic}' failed at segment {segment_number + 1}, re-run with resume to continue")
 
             current_story += " " + segment_content
+            feed.add(" " + segment_content)
+            context.add_segment(segment_content)
             total_tokens_used += tokens_used
+            story_tokens += count_tokens(segment_content)
             total_time_taken += time_taken
-            logging.info(f"Generated segment in {time_taken:.2f} seconds using {tokens_used} tokens. Total tokens used: {total_tokens_used}")
+            segment_number += 1
+            manifest.record(f"story/segment_{segment_number}", content_hash(segment_content), text=segment_content, tokens_used=tokens_used, time_taken=time_taken, context=context.to_dict())
+            logging.info(f"Generated segment in {time_taken:.2f} seconds using {tokens_used} tokens. Story length: {story_tokens}/{total_token_limit} tokens, total tokens used: {total_tokens_used}")
 
-            if any(marker in segment_content for marker in end_markers):
+            if has_end_marker(segment_content, end_markers):
                 logging.info("End marker detected, concluding story generation.")
-                break
+                story_ended = True
 
-        current_story += "\n\nThat is the end of our story today, thank you so much for listening. Please, let me know your thoughts, and be well my friends."
+        current_story += STORY_ENDING
+        feed.add(STORY_ENDING)
+        feed.flush()
 
-        intro_content, _, _ = generate_intro(client, story_topic, world_detail)
-        final_story = f"Today's story is called '{story_topic}'\n\n{intro_content}\n\n{current_story}"
+        final_story = story_header + current_story
 
-        foldername = story_topic.replace(' ', '_').lower()
         filename = f"{foldername}.txt"
         filepath = save_story_to_file(final_story, foldername, filename)
+        manifest.record("story", file_hash(filepath), path=filepath, topic=story_topic)
+        if stream_path:
+            os.remove(stream_path)
 
-        story_cost = total_tokens_used * token_cost_per_million
+        story_cost = story_client.recorder.total_cost(story=story_topic, stage="story")
+        story_usage = story_client.recorder.summarize(story_client.recorder.select(story=story_topic, stage="story"))
         total_cost += story_cost
         logging.info(f"Total time taken: {total_time_taken:.2f} seconds")
-        logging.info(f"Total tokens used: {total_tokens_used}")
+        logging.info(f"Total tokens used: {total_tokens_used} (plus {context.tokens_used} for keeping the story summary)")
+        logging.info(f"Cached prompt tokens: {story_usage['cached_tokens']} of {story_usage['prompt_tokens']}, saving ${story_usage['cache_savings']:.4f}")
         logging.info(f"Total cost: ${story_cost:.2f}")
 
         generated_story_paths.append(filepath)
@@ -137,15 +367,9 @@ def generate_story(api_key, story_topics, world_details, intended_audience, max_
     return generated_story_paths, total_cost
 
 def generate_summary(client, story_content, max_tokens=4095):
-    prompt = f"Provide a concise summary of the following story:\n\n{story_content}"
     try:
         response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
+            messages=build_messages(story_content, SUMMARY_SYSTEM_PROMPT),
             model="gpt-4o",
             max_tokens=max_tokens
         )
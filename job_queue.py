@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+# Durable queue of story jobs in a local SQLite file, shared by the batch runner's worker processes and the daemon.
+# A job is claimed inside a write transaction, so two workers never take the same one, and a claimed job carries
+# its worker ("host:pid") and a heartbeat. Jobs whose worker died are put back in the queue, so a crashed or
+# killed batch continues where it stopped; the story's run manifest then skips the work that already finished.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    topic TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    last_error TEXT,
+    outputs TEXT,
+    cost REAL,
+    created_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL,
+    duration REAL
+)
+"""
+
+STATUSES = ("queued", "running", "done", "failed")
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by someone else
+    return True
+
+class JobQueue:
+    def __init__(self, path, lease_seconds=300):
+        # A running job whose heartbeat is older than lease_seconds is treated as abandoned
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        with self._connect() as connection:
+            connection.execute(SCHEMA)
+
+    def _connect(self):
+        # One short-lived connection per operation, so the queue can be used from any process or thread.
+        # WAL lets readers (status, the summary) run while a worker writes; timeout waits out a busy writer.
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        return _Closing(connection)
+
+    def add_jobs(self, jobs, max_attempts=3):
+        # jobs are dicts with "topic" and the rest of the job spec. One job per story folder: adding the same
+        # JSONL file again (e.g. after a restart) leaves the existing jobs and their status alone
+        added = 0
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for job in jobs:
+                added += self._insert(connection, job, max_attempts, now)
+            connection.execute("COMMIT")
+        logging.info(f"Queued {added} new jobs, {len(jobs) - added} were already in {self.path}")
+        return added
+
+    def add_job(self, job, max_attempts=3):
+        # Returns the job and whether it is new; a story folder that is already queued returns the existing job
+        from generate_story import story_folder
+
+        with self._connect() as connection:
+            added = self._insert(connection, job, max_attempts, time.time())
+            row = connection.execute("SELECT * FROM jobs WHERE folder = ?", (story_folder(job["topic"]),)).fetchone()
+        return self._job(row), bool(added)
+
+    def _insert(self, connection, job, max_attempts, now):
+        from generate_story import story_folder
+
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO jobs (folder, topic, spec, max_attempts, created_at, available_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (story_folder(job["topic"]), job["topic"], json.dumps(job), max_attempts, now, now))
+        return cursor.rowcount
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def claim(self, worker=None):
+        # Takes the oldest job that is ready to run, or returns None
+        worker = worker or worker_name()
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT * FROM jobs WHERE status = 'queued' AND available_at <= ? ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                               (worker, now, now, row["id"]))
+            connection.execute("COMMIT")
+        job = self._job(row)
+        # started_at survives fail, release and requeue_abandoned, so it tells whether any earlier run got going;
+        # attempts can't, since release gives the attempt back
+        job.update(status="running", attempts=row["attempts"] + 1, worker=worker, started_at=now, resume=row["started_at"] is not None)
+        return job
+
+    def heartbeat(self, job_id):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def complete(self, job_id, outputs, cost=None):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = 'done', outputs = ?, cost = ?, last_error = NULL, finished_at = ?, duration = ? - started_at WHERE id = ?",
+                               (json.dumps(outputs), cost, now, now, job_id))
+
+    def fail(self, job_id, error, retry_delay=60):
+        # Back in the queue after a growing delay until max_attempts is used up, then failed for good
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row["attempts"] < row["max_attempts"]:
+                delay = retry_delay * 2 ** (row["attempts"] - 1)
+                connection.execute("UPDATE jobs SET status = 'queued', last_error = ?, worker = NULL, available_at = ? WHERE id = ?",
+                                   (str(error), now + delay, job_id))
+                status = f"queued again in {delay:.0f} seconds (attempt {row['attempts']} of {row['max_attempts']})"
+            else:
+                connection.execute("UPDATE jobs SET status = 'failed', last_error = ?, finished_at = ?, duration = ? - started_at WHERE id = ?",
+                                   (str(error), now, now, job_id))
+                status = f"failed after {row['attempts']} attempts"
+            connection.execute("COMMIT")
+        return status
+
+    def release(self, job_id):
+        # The worker is stopping (e.g. Ctrl-C) before the job finished; it goes back without using up an attempt
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, available_at = ? WHERE id = ? AND status = 'running'",
+                               (time.time(), job_id))
+
+    def requeue_abandoned(self):
+        # Running jobs whose worker process is gone (same host) or has stopped heartbeating (any host).
+        # The attempt they were on still counts, so a job that keeps crashing its worker ends up failed.
+        host = socket.gethostname()
+        now = time.time()
+        requeued = []
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for row in connection.execute("SELECT id, topic, worker, heartbeat_at FROM jobs WHERE status = 'running'").fetchall():
+                worker_host, _, pid = (row["worker"] or "").rpartition(":")
+                dead = worker_host == host and pid.isdigit() and not process_alive(int(pid))
+                if dead or (row["heartbeat_at"] or 0) < now - self.lease_seconds:
+                    connection.execute("UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END, "
+                                       "last_error = ?, worker = NULL, available_at = ? WHERE id = ?",
+                                       (f"Worker {row['worker']} stopped while running the job", now, row["id"]))
+                    requeued.append(row["topic"])
+            connection.execute("COMMIT")
+        if requeued:
+            logging.warning(f"Put {len(requeued)} abandoned jobs back in the queue: {', '.join(requeued)}")
+        return requeued
+
+    def next_available(self):
+        # When the next queued job becomes ready (it may be waiting out a retry delay), None when nothing is queued
+        with self._connect() as connection:
+            return connection.execute("SELECT MIN(available_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def jobs(self, status=None):
+        with self._connect() as connection:
+            if status:
+                rows = connection.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id", (status,)).fetchall()
+            else:
+                rows = connection.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self):
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def _job(self, row):
+        job = dict(row)
+        job["spec"] = json.loads(job["spec"])
+        job["outputs"] = json.loads(job["outputs"]) if job["outputs"] else None
+        return job
+
+class _Closing:
+    # sqlite3's own context manager commits but never closes the connection
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None and self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+        self.connection.close()
@@ -0,0 +1,351 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+# One place for API timing, usage and cost. instrument() wraps a client so every chat, speech and image call is
+# recorded with its latency, tokens, characters, images, retries and cost; the recorder exports a JSON report
+# and a Prometheus textfile.
+
+# USD list prices. Chat models are per token (input, cached input, output), speech per character,
+# images per image keyed by (quality, size).
+MODEL_PRICES = {
+    "gpt-4o": {"input": 2.50 / 1_000_000, "cached_input": 1.25 / 1_000_000, "output": 10.00 / 1_000_000},
+    "gpt-4o-mini": {"input": 0.15 / 1_000_000, "cached_input": 0.075 / 1_000_000, "output": 0.60 / 1_000_000},
+    "tts-1": {"character": 15.00 / 1_000_000},
+    "tts-1-hd": {"character": 30.00 / 1_000_000},
+    "dall-e-3": {"image": {
+        ("standard", "1024x1024"): 0.040, ("standard", "1024x1792"): 0.080, ("standard", "1792x1024"): 0.080,
+        ("hd", "1024x1024"): 0.080, ("hd", "1024x1792"): 0.120, ("hd", "1792x1024"): 0.120,
+    }},
+    "dall-e-2": {"image": {("standard", "256x256"): 0.016, ("standard", "512x512"): 0.018, ("standard", "1024x1024"): 0.020}},
+}
+
+# The Batch API bills chat tokens at half the list price
+BATCH_DISCOUNT = 0.5
+
+_unpriced_models = set()
+
+def _prices(model):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # Dated snapshots ("gpt-4o-2024-08-06") are priced like their base model
+        prices = next((value for name, value in MODEL_PRICES.items() if model.startswith(f"{name}-")), None)
+    if prices is None and model not in _unpriced_models:
+        _unpriced_models.add(model)
+        logging.warning(f"No price known for model {model}, its calls are counted at $0")
+    return prices or {}
+
+def chat_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    prices = _prices(model)
+    if not prices:
+        return 0.0
+    return ((prompt_tokens - cached_tokens) * prices["input"] + cached_tokens * prices["cached_input"]
+            + completion_tokens * prices["output"])
+
+def cache_savings(model, cached_tokens):
+    # What prefix caching took off the bill: the cached tokens would otherwise have been full-price input
+    prices = _prices(model)
+    if not prices or "cached_input" not in prices:
+        return 0.0
+    return cached_tokens * (prices["input"] - prices["cached_input"])
+
+def speech_cost(model, characters):
+    return characters * _prices(model).get("character", 0.0)
+
+def image_cost(model, quality="standard", size="1024x1024", count=1):
+    return count * _prices(model).get("image", {}).get((quality, size), 0.0)
+
+_call_state = threading.local()
+
+def note_retry():
+    # Called by retry code between attempts, so the call being recorded on this thread knows how often it was retried
+    if getattr(_call_state, "retries", None) is not None:
+        _call_state.retries += 1
+
+class MetricsRecorder:
+    def __init__(self, max_records=None):
+        # max_records keeps only the latest calls and stages, for a long-running process (the daemon). The
+        # story-less Prometheus counters and the cost per story are running totals, so they count everything.
+        self.calls = deque(maxlen=max_records)
+        self.stages = deque(maxlen=max_records)
+        self.totals = defaultdict(float)
+        self.story_costs = defaultdict(float)
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+
+    def record_call(self, **fields):
+        with self.lock:
+            self.calls.append(fields)
+            _count_call(self.totals, fields, per_story=False)
+            self.story_costs[fields.get("story") or ""] += fields["cost"]
+
+    def record_stage(self, story, stage, duration, status="ok"):
+        with self.lock:
+            self.stages.append({"story": story, "stage": stage, "duration": duration, "status": status})
+            _count_stage(self.totals, self.stages[-1], per_story=False)
+
+    def pop_story_cost(self, story):
+        # Running cost of one story, forgotten afterwards so a long-running process doesn't keep every story's total
+        with self.lock:
+            return self.story_costs.pop(story, 0.0)
+
+    def select(self, **labels):
+        with self.lock:
+            return [call for call in self.calls if all(call.get(key) == value for key, value in labels.items())]
+
+    def total_cost(self, **labels):
+        return sum(call["cost"] for call in self.select(**labels))
+
+    def summarize(self, calls):
+        summary = {
+            "calls": len(calls),
+            "errors": sum(1 for call in calls if call.get("error")),
+            "retries": sum(call.get("retries", 0) for call in calls),
+            "latency_seconds": sum(call["latency"] for call in calls),
+            "prompt_tokens": sum(call.get("prompt_tokens", 0) for call in calls),
+            "cached_tokens": sum(call.get("cached_tokens", 0) for call in calls),
+            "completion_tokens": sum(call.get("completion_tokens", 0) for call in calls),
+            "characters": sum(call.get("characters", 0) for call in calls),
+            "images": sum(call.get("images", 0) for call in calls),
+            "cost": sum(call["cost"] for call in calls),
+            "cache_savings": sum(cache_savings(call["model"], call.get("cached_tokens", 0)) for call in calls),
+        }
+        summary["cost"] = round(summary["cost"], 6)
+        summary["cache_savings"] = round(summary["cache_savings"], 6)
+        return summary
+
+    def report(self):
+        with self.lock:
+            calls = list(self.calls)
+            stages = list(self.stages)
+        by_story = defaultdict(list)
+        by_endpoint = defaultdict(list)
+        for call in calls:
+            by_story[call.get("story") or ""].append(call)
+            by_endpoint[f"{call['endpoint']}:{call['model']}"].append(call)
+        stories = {}
+        for story, story_calls in by_story.items():
+            stories[story] = self.summarize(story_calls)
+            stories[story]["stages"] = {stage["stage"]: round(stage["duration"], 3) for stage in stages if stage["story"] == story}
+        return {
+            "started_at": self.started_at,
+            "finished_at": time.time(),
+            "totals": self.summarize(calls),
+            "by_endpoint": {name: self.summarize(endpoint_calls) for name, endpoint_calls in by_endpoint.items()},
+            "stories": stories,
+            "calls": calls,
+        }
+
+    def write_json(self, path):
+        _atomic_write(path, json.dumps(self.report(), indent=2, default=str))
+        logging.info(f"Metrics report saved to {path}")
+
+    def write_prometheus(self, path, prefix="story_pipeline"):
+        # Textfile collector format (e.g. node_exporter --collector.textfile.directory)
+        _atomic_write(path, self.prometheus_text(prefix))
+        logging.info(f"Prometheus metrics saved to {path}")
+
+    def prometheus_text(self, prefix="story_pipeline", per_story=True):
+        # per_story=False drops the story label and sums stage durations per stage, for a long-running process
+        # whose stories would otherwise each add their own series; those come from the running totals, not a rescan
+        with self.lock:
+            if per_story:
+                counters = defaultdict(float)
+                for call in self.calls:
+                    _count_call(counters, call, per_story=True)
+                for stage in self.stages:
+                    _count_stage(counters, stage, per_story=True)
+            else:
+                counters = dict(self.totals)
+
+        lines = []
+        declared = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"{prefix}_{name}"
+            family = metric.rsplit("_sum", 1)[0].rsplit("_count", 1)[0]
+            if family not in declared:
+                declared.add(family)
+                metric_type = "summary" if family != metric else ("gauge" if name == "stage_duration_seconds" else "counter")
+                lines.append(f"# TYPE {family} {metric_type}")
+            label_text = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels)
+            lines.append(f"{metric}{{{label_text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        totals = self.report()["totals"]
+        logging.info(f"API usage: {totals['calls']} calls ({totals['errors']} failed, {totals['retries']} retries), "
+                     f"{totals['prompt_tokens']} prompt ({totals['cached_tokens']} cached) / {totals['completion_tokens']} completion tokens, "
+                     f"{totals['characters']} TTS characters, {totals['images']} images")
+        logging.info(f"Total API cost: ${totals['cost']:.4f} (prompt caching saved ${totals['cache_savings']:.4f})")
+
+def _count_call(counters, call, per_story=True):
+    labels = (("endpoint", call["endpoint"]), ("model", call["model"])) + ((("story", call.get("story") or ""),) if per_story else ()) + (("stage", call.get("stage") or ""),)
+    counters[("api_calls_total", labels)] += 1
+    counters[("api_errors_total", labels)] += 1 if call.get("error") else 0
+    counters[("api_retries_total", labels)] += call.get("retries", 0)
+    counters[("api_latency_seconds_sum", labels)] += call["latency"]
+    counters[("api_latency_seconds_count", labels)] += 1
+    counters[("api_cost_dollars_total", labels)] += call["cost"]
+    counters[("api_cache_savings_dollars_total", labels)] += cache_savings(call["model"], call.get("cached_tokens", 0))
+    for kind in ("prompt", "cached", "completion"):
+        counters[("api_tokens_total", labels + (("kind", kind),))] += call.get(f"{kind}_tokens", 0)
+    counters[("api_characters_total", labels)] += call.get("characters", 0)
+    counters[("api_images_total", labels)] += call.get("images", 0)
+
+def _count_stage(counters, stage, per_story=True):
+    if per_story:
+        counters[("stage_duration_seconds", (("story", stage["story"]), ("stage", stage["stage"])))] = stage["duration"]
+    else:
+        labels = (("stage", stage["stage"]), ("status", stage["status"]))
+        counters[("stage_duration_seconds_sum", labels)] += stage["duration"]
+        counters[("stage_duration_seconds_count", labels)] += 1
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _atomic_write(path, text):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path)
+
+class InstrumentedClient:
+    # Wraps an OpenAI (or FakeOpenAI) client; anything not wrapped here is passed straight through
+    def __init__(self, client, recorder, labels=None):
+        self._client = client
+        self.recorder = recorder
+        self.labels = labels or {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(create=self._speech_create))
+        self.images = SimpleNamespace(generate=self._images_generate)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def with_labels(self, **labels):
+        # Same client and recorder, with extra labels (story, stage) on every call made through the copy
+        return InstrumentedClient(self._client, self.recorder, {**self.labels, **labels})
+
+    def _call(self, endpoint, model, call, measure):
+        outer_retries = getattr(_call_state, "retries", None)
+        _call_state.retries = 0
+        start_time = time.perf_counter()
+        try:
+            response = call()
+        except Exception as e:
+            self.recorder.record_call(endpoint=endpoint, model=model, latency=time.perf_counter() - start_time,
+                                      retries=_call_state.retries, cost=0.0, error=type(e).__name__, **self.labels)
+            raise
+        finally:
+            retries = _call_state.retries
+            _call_state.retries = outer_retries
+        fields = measure(response)
+        if fields is not None:
+            self.recorder.record_call(endpoint=endpoint, model=model, latency=time.perf_counter() - start_time,
+                                      retries=retries, **fields, **self.labels)
+        return response
+
+    def _chat_create(self, **kwargs):
+        model = kwargs.get("model", "")
+
+        def measure(response):
+            if kwargs.get("stream"):
+                return None  # Recorded by InstrumentedStream once the stream ends
+            return _chat_usage_fields(model, response.usage)
+
+        start_time = time.perf_counter()
+        response = self._call("chat", model, lambda: self._client.chat.completions.create(**kwargs), measure)
+        if kwargs.get("stream"):
+            prompt_chars = sum(len(str(message.get("content", ""))) for message in kwargs.get("messages", []))
+            return InstrumentedStream(response, self, model, start_time, prompt_chars)
+        return response
+
+    def _speech_create(self, **kwargs):
+        model = kwargs.get("model", "")
+        characters = len(kwargs.get("input", ""))
+        return self._call("speech", model, lambda: self._client.audio.speech.create(**kwargs),
+                          lambda response: {"characters": characters, "cost": speech_cost(model, characters)})
+
+    def _images_generate(self, **kwargs):
+        model = kwargs.get("model", "dall-e-2")
+        quality = kwargs.get("quality", "standard")
+        size = kwargs.get("size", "1024x1024")
+
+        def measure(response):
+            count = len(response.data)
+            return {"images": count, "cost": image_cost(model, quality, size, count)}
+        return self._call("images", model, lambda: self._client.images.generate(**kwargs), measure)
+
+def _chat_usage_fields(model, usage, estimated=False):
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cost": chat_cost(model, usage.prompt_tokens, usage.completion_tokens, cached_tokens),
+        "estimated": estimated,
+    }
+
+def batch_chat_fields(model, usage):
+    # One Batch API result: usage is the response body's usage dict
+    details = usage.get("prompt_tokens_details") or {}
+    fields = _chat_usage_fields(model, SimpleNamespace(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"],
+                                                       prompt_tokens_details=SimpleNamespace(cached_tokens=details.get("cached_tokens", 0))))
+    fields["cost"] *= BATCH_DISCOUNT
+    return fields
+
+class InstrumentedStream:
+    # Passes chunks through and records the call when the stream ends or is closed early
+    def __init__(self, stream, client, model, start_time, prompt_chars):
+        self._stream = stream
+        self._client = client
+        self._model = model
+        self._start_time = start_time
+        self._prompt_chars = prompt_chars
+        self._usage = None
+        self._content_chunks = 0
+        self._first_token_time = None
+        self._recorded = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if getattr(chunk, "usage", None):
+                    self._usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self._content_chunks += 1
+                    if self._first_token_time is None:
+                        self._first_token_time = time.perf_counter()
+                yield chunk
+        finally:
+            self._record()
+
+    def close(self):
+        self._stream.close()
+        self._record()
+
+    def _record(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        if self._usage is not None:
+            fields = _chat_usage_fields(self._model, self._usage)
+        else:
+            # Closed before the usage chunk: one token per content delta, prompt estimated from its length
+            usage = SimpleNamespace(prompt_tokens=self._prompt_chars // 4, completion_tokens=self._content_chunks)
+            fields = _chat_usage_fields(self._model, usage, estimated=True)
+        if self._first_token_time is not None:
+            fields["time_to_first_token"] = self._first_token_time - self._start_time
+        self._client.recorder.record_call(endpoint="chat", model=self._model, latency=time.perf_counter() - self._start_time,
+                                          retries=0, **fields, **self._client.labels)
+
+def instrument(client, recorder=None, **labels):
+    # Wraps client unless it already is instrumented, in which case only the labels are added
+    if isinstance(client, InstrumentedClient):
+        return client.with_labels(**labels) if labels else client
+    return InstrumentedClient(client, recorder or MetricsRecorder(), labels)
@@ -0,0 +1,135 @@
+import logging
+from collections import namedtuple
+
+# Frame level MPEG audio (Layer III) helpers, used to join, time and fake MP3 files without decoding them to PCM
+
+CHUNK_SIZE = 64 * 1024
+
+BITRATES_KBPS = {
+    1.0: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2.0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    2.5: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+    1.0: [44100, 48000, 32000],
+    2.0: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+VERSION_BITS = {0b11: 1.0, 0b10: 2.0, 0b00: 2.5}
+
+FrameHeader = namedtuple("FrameHeader", "version bitrate sample_rate channels protected padding frame_length samples")
+
+def parse_frame_header(data):
+    # Returns a FrameHeader for a valid Layer III header, None for anything else
+    if len(data) < 4 or data[0] != 0xFF or (data[1] & 0xE0) != 0xE0:
+        return None
+    version = VERSION_BITS.get((data[1] >> 3) & 0b11)
+    layer_bits = (data[1] >> 1) & 0b11
+    bitrate_index = data[2] >> 4
+    sample_rate_index = (data[2] >> 2) & 0b11
+    if version is None or layer_bits != 0b01 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = BITRATES_KBPS[version][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[2] >> 1) & 1
+    channels = 1 if (data[3] >> 6) == 0b11 else 2
+    protected = not (data[1] & 1)
+    if version == 1.0:
+        frame_length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        frame_length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    return FrameHeader(version, bitrate, sample_rate, channels, protected, padding, frame_length, samples)
+
+def build_frame_header(version, bitrate, sample_rate, channels, padding=0):
+    version_bits = {value: key for key, value in VERSION_BITS.items()}[version]
+    bitrate_index = BITRATES_KBPS[version].index(bitrate // 1000)
+    sample_rate_index = SAMPLE_RATES[version].index(sample_rate)
+    channel_mode = 0b11 if channels == 1 else 0b00
+    header = (0x7FF << 21) | (version_bits << 19) | (0b01 << 17) | (1 << 16) | (bitrate_index << 12) | (sample_rate_index << 10) | (padding << 9) | (channel_mode << 6)
+    return header.to_bytes(4, "big")
+
+def side_info_size(version, channels):
+    if version == 1.0:
+        return 17 if channels == 1 else 32
+    return 9 if channels == 1 else 17
+
+def is_info_frame(header, frame):
+    # Xing/Info/VBRI frames carry the encoder's length metadata rather than audio; it is wrong once files are joined
+    offset = 4 + (2 if header.protected else 0) + side_info_size(header.version, header.channels)
+    return frame[offset:offset + 4] in (b"Xing", b"Info") or frame[36:40] == b"VBRI"
+
+def id3v2_size(data):
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = ((data[6] & 0x7F) << 21) | ((data[7] & 0x7F) << 14) | ((data[8] & 0x7F) << 7) | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def iter_frames(path, chunk_size=CHUNK_SIZE, skip_info=True):
+    # Yields (FrameHeader, frame bytes) while holding at most a chunk or two of the file in memory
+    with open(path, "rb") as audio_file:
+        audio_file.seek(id3v2_size(audio_file.read(10)))
+        buffer = b""
+        offset = 0
+        eof = False
+        while True:
+            if len(buffer) - offset < 4 and not eof:
+                chunk = audio_file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[offset:] + chunk
+                offset = 0
+                continue
+            if len(buffer) - offset < 4:
+                return
+            header = parse_frame_header(buffer[offset:offset + 4])
+            if header is None:
+                if buffer[offset:offset + 3] == b"TAG":
+                    return
+                next_sync = buffer.find(b"\xff", offset + 1)
+                offset = next_sync if next_sync != -1 else len(buffer)
+                continue
+            end = offset + header.frame_length
+            if end > len(buffer):
+                if eof:
+                    logging.warning(f"Dropping truncated frame at the end of {path}")
+                    return
+                chunk = audio_file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[offset:] + chunk
+                offset = 0
+                continue
+            frame = buffer[offset:end]
+            offset = end
+            if skip_info and is_info_frame(header, frame):
+                continue
+            yield header, frame
+
+def probe(path):
+    # Header of the first audio frame, or None if the file holds no Layer III audio
+    for header, _ in iter_frames(path):
+        return header
+    return None
+
+def silent_frame(version, bitrate, sample_rate, channels):
+    # All-zero side info and main data decode to one frame of digital silence, no encoder needed
+    header = parse_frame_header(build_frame_header(version, bitrate, sample_rate, channels))
+    return build_frame_header(version, bitrate, sample_rate, channels) + bytes(header.frame_length - 4)
+
+def silence_frame_count(version, sample_rate, duration_ms):
+    samples_per_frame = 1152 if version == 1.0 else 576
+    return round(duration_ms / 1000 * sample_rate / samples_per_frame)
+
+def silence_duration(version, sample_rate, duration_ms):
+    # Seconds of the silence() actually produced, which is rounded to whole frames
+    samples_per_frame = 1152 if version == 1.0 else 576
+    return silence_frame_count(version, sample_rate, duration_ms) * samples_per_frame / sample_rate
+
+def silence(version, bitrate, sample_rate, channels, duration_ms):
+    frame = silent_frame(version, bitrate, sample_rate, channels)
+    return frame * silence_frame_count(version, sample_rate, duration_ms)
+
+def duration(path):
+    # Seconds of audio from the frame headers alone (samples per frame / sample rate), without decoding anything
+    return sum(header.samples / header.sample_rate for header, _ in iter_frames(path))
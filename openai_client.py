@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import metrics
+from token_counter import count_message_tokens
+
+# Shared OpenAI client for every module: one pooled HTTP connection set, token buckets for requests/min and
+# tokens/min per model that follow the x-ratelimit-* response headers, and jittered exponential retry
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30_000
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def parse_reset(value):
+    # "1s", "6m0s", "20ms", "1h2m3.5s" -> seconds
+    if not value:
+        return None
+    total = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+class TokenBucket:
+    def __init__(self, per_minute, cap=None):
+        # limit is the account's (or the server's, once it reports one); cap is a ceiling of our own below it
+        self.limit = per_minute
+        self.cap = cap
+        self.capacity = min(per_minute, cap) if cap else per_minute
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                amount = min(amount, self.capacity)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.level >= amount:
+                    self.level -= amount
+                    return
+                else:
+                    wait = (amount - self.level) / self.rate
+            time.sleep(wait)
+
+    def update(self, limit=None, remaining=None):
+        # The server's view wins: its limit sets the rate (under our own cap), and its remaining count caps what we think is left
+        with self.lock:
+            self._refill(time.monotonic())
+            if limit:
+                self.limit = limit
+                self._apply_limits()
+            if remaining is not None:
+                self.level = min(self.level, remaining)
+
+    def set_cap(self, cap):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.cap = cap
+            self._apply_limits()
+
+    def _apply_limits(self):
+        self.capacity = min(self.limit, self.cap) if self.cap else self.limit
+        self.rate = self.capacity / 60
+        self.level = min(self.level, self.capacity)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_caps = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def for_model(self, model):
+        with self.lock:
+            if model not in self.buckets:
+                self.buckets[model] = (TokenBucket(self.requests_per_minute, self.request_caps.get(model)), TokenBucket(self.tokens_per_minute))
+            return self.buckets[model]
+
+    def cap_requests(self, model, requests_per_minute):
+        # Holds one model below the account's limit, e.g. speech, whatever the response headers allow
+        with self.lock:
+            self.request_caps[model] = requests_per_minute
+            bucket = self.buckets.get(model, (None,))[0]
+        if bucket is not None:
+            bucket.set_cap(requests_per_minute)
+
+    def acquire(self, model, tokens=0):
+        requests, token_bucket = self.for_model(model)
+        requests.acquire(1)
+        if tokens:
+            token_bucket.acquire(tokens)
+
+    def observe(self, model, headers, status_code=200):
+        requests, token_bucket = self.for_model(model)
+
+        def header_int(name):
+            value = headers.get(name)
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                return None
+
+        requests.update(header_int("x-ratelimit-limit-requests"), header_int("x-ratelimit-remaining-requests"))
+        token_bucket.update(header_int("x-ratelimit-limit-tokens"), header_int("x-ratelimit-remaining-tokens"))
+        if status_code == 429:
+            retry_after = retry_after_seconds(headers) or parse_reset(headers.get("x-ratelimit-reset-requests")) or 1.0
+            requests.pause(retry_after)
+            logging.warning(f"Rate limited on {model}, pausing new {model} requests for {retry_after:.1f} seconds")
+
+    def observe_response(self, response):
+        # httpx response hook: every API response, including errors, keeps the buckets in step with the server.
+        # Only JSON bodies name a model; a multipart upload (files.create) is streamed, and reading its
+        # .content would raise httpx.RequestNotRead
+        model = ""
+        if response.request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                model = json.loads(response.request.content or b"{}").get("model", "")
+            except (ValueError, AttributeError):
+                pass
+        self.observe(model, response.headers, response.status_code)
+
+def retry_after_seconds(headers):
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        value = headers.get(name) if headers else None
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return None
+
+def is_retryable(error):
+    if getattr(error, "code", None) == "insufficient_quota":
+        return False  # Billing problem, waiting will not help
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "RemoteProtocolError")
+
+def call_with_retry(call, max_retries=6, base_delay=1.0, max_delay=60.0, description="API call"):
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            headers = getattr(e, "headers", None) or getattr(getattr(e, "response", None), "headers", None) or {}
+            # Full jitter keeps concurrent workers from retrying in lockstep; a server-given retry-after is a floor
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            delay = max(delay, retry_after_seconds(headers) or 0)
+            attempt += 1
+            metrics.note_retry()
+            logging.warning(f"{description} failed ({e}), retry {attempt}/{max_retries} in {delay:.1f} seconds")
+            time.sleep(delay)
+
+def estimate_request_tokens(kwargs):
+    # Tokens/min charge before the call, the way the API counts it: prompt tokens plus max_tokens
+    return count_message_tokens(kwargs.get("messages", []), kwargs.get("model", "gpt-4o")) + (kwargs.get("max_tokens") or 0)
+
+class ResilientClient:
+    # Puts every chat, speech and image call behind the shared rate limiter and the retry policy
+    def __init__(self, client, limiter, max_retries=6):
+        self._client = client
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.audio = SimpleNamespace(speech=SimpleNamespace(create=self._speech_create))
+        self.images = SimpleNamespace(generate=self._images_generate)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _call(self, model, tokens, call, description):
+        def attempt():
+            self.limiter.acquire(model, tokens)
+            return call()
+        return call_with_retry(attempt, self.max_retries, description=description)
+
+    def _chat_create(self, **kwargs):
+        return self._call(kwargs.get("model", ""), estimate_request_tokens(kwargs),
+                          lambda: self._client.chat.completions.create(**kwargs), "Chat completion")
+
+    def _speech_create(self, **kwargs):
+        return self._call(kwargs.get("model", ""), 0, lambda: self._client.audio.speech.create(**kwargs), "Speech synthesis")
+
+    def _images_generate(self, **kwargs):
+        return self._call(kwargs.get("model", ""), 0, lambda: self._client.images.generate(**kwargs), "Image generation")
+
+def get_client(api_key=None, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+               max_connections=32, max_retries=6, timeout=600.0):
+    # One client per API key for the whole process, so every stage shares connections and rate limits
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
+    with _clients_lock:
+        if api_key not in _clients:
+            import httpx
+            from openai import OpenAI
+
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=timeout,
+                event_hooks={"response": [limiter.observe_response]},
+            )
+            # The SDK's own retries are off; call_with_retry does it with jitter and counts the retries
+            client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            _clients[api_key] = ResilientClient(client, limiter, max_retries)
+        return _clients[api_key]
+
+def wrap_client(client, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, max_retries=6):
+    # Same limiter and retry policy around any client object, e.g. the local FakeOpenAI
+    return ResilientClient(client, RateLimiter(requests_per_minute, tokens_per_minute), max_retries)
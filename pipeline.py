@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Minimal dependency-graph executor: every stage starts as soon as the stages it depends on have finished
+
+class Stage:
+    def __init__(self, name, func, depends_on=()):
+        # func receives the dict of results from the stages finished so far, keyed by stage name
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+
+class StageLimiter:
+    # Caps how many runs of each stage are in flight at once across every story that shares the limiter,
+    # e.g. {"audio": 2, "video": 1}; stages without a limit run freely
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in self.limits.items()}
+        self.lock = threading.Lock()
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(int)
+        self.wait_seconds = defaultdict(float)
+
+    def limit(self, stages):
+        return [Stage(stage.name, self._wrap(stage), stage.depends_on) if stage.name in self.semaphores else stage for stage in stages]
+
+    def _wrap(self, stage):
+        semaphore = self.semaphores[stage.name]
+
+        def func(results):
+            with self.lock:
+                self.waiting[stage.name] += 1
+            start = time.perf_counter()
+            with semaphore:
+                with self.lock:
+                    self.waiting[stage.name] -= 1
+                    self.running[stage.name] += 1
+                    self.wait_seconds[stage.name] += time.perf_counter() - start
+                try:
+                    return stage.func(results)
+                finally:
+                    with self.lock:
+                        self.running[stage.name] -= 1
+        return func
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {"limit": limit, "running": self.running[name], "waiting": self.waiting[name], "wait_seconds": round(self.wait_seconds[name], 3)}
+                    for name, limit in self.limits.items()}
+
+class StageTiming:
+    def __init__(self, name, start, end, status):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.status = status
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+def run_stages(stages, max_workers=4, label="pipeline", timings=None):
+    # Pass a dict as timings to get each stage's StageTiming back, keyed by stage name
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [name for name in stage.depends_on if name not in stages_by_name]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages: {missing}")
+
+    results = {}
+    timings = {} if timings is None else timings
+    failed = {}
+    pending = {stage.name for stage in stages}
+    running = {}
+    pipeline_start = time.perf_counter()
+
+    def run(stage):
+        start = time.perf_counter() - pipeline_start
+        try:
+            return stage.func(results)
+        finally:
+            timings[stage.name] = StageTiming(stage.name, start, time.perf_counter() - pipeline_start, "ok")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                stage = stages_by_name[name]
+                if any(dependency in failed for dependency in stage.depends_on):
+                    # A failed dependency means this stage can never run; record it and let its own dependents skip too
+                    pending.discard(name)
+                    failed[name] = None
+                    now = time.perf_counter() - pipeline_start
+                    timings[name] = StageTiming(name, now, now, "skipped")
+                    logging.warning(f"Skipping stage '{name}' because a stage it depends on failed")
+                elif all(dependency in results for dependency in stage.depends_on):
+                    pending.discard(name)
+                    running[executor.submit(run, stage)] = name
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Stages {sorted(pending)} depend on each other in a cycle")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.error(f"Stage '{name}' failed: {e}")
+                    failed[name] = e
+                    timings[name].status = "failed"
+
+    log_timeline(timings, stages_by_name, label)
+    first_error = next((error for error in failed.values() if error is not None), None)
+    if first_error is not None:
+        raise first_error
+    return results
+
+def critical_path(timings, stages_by_name):
+    # Walks back from the stage that finished last, always through the dependency that finished last
+    if not timings:
+        return []
+    current = max(timings.values(), key=lambda timing: timing.end).name
+    path = [current]
+    while True:
+        dependencies = [name for name in stages_by_name[current].depends_on if name in timings]
+        if not dependencies:
+            break
+        current = max(dependencies, key=lambda name: timings[name].end)
+        path.append(current)
+    return list(reversed(path))
+
+def log_timeline(timings, stages_by_name, label="pipeline"):
+    path = critical_path(timings, stages_by_name)
+    total = max((timing.end for timing in timings.values()), default=0)
+    logging.info(f"Stage timeline for {label} ({total:.2f} seconds, * marks the critical path):")
+    for timing in sorted(timings.values(), key=lambda timing: timing.start):
+        marker = "*" if timing.name in path else " "
+        logging.info(f" {marker} {timing.name:<12} {timing.start:8.2f}s -> {timing.end:8.2f}s  {timing.duration:8.2f}s  {timing.status}")
+    logging.info(f"Critical path: {' -> '.join(path)}")
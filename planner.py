@@ -0,0 +1,189 @@
+import json
+import logging
+import math
+import os
+import statistics
+
+from generate_story import (STORY_SYSTEM_PROMPT, INTRO_SYSTEM_PROMPT, SUMMARY_SYSTEM_PROMPT, END_MARKERS, STORY_ENDING,
+                            build_messages, build_story_prompt, build_intro_prompt)
+from metrics import chat_cost, speech_cost, image_cost
+from text_to_audio import TTS_INPUT_LIMITS
+from token_counter import count_tokens, count_message_tokens, CHARS_PER_TOKEN
+
+# Dry-run budget for a batch of topics: how many segments, tokens, TTS characters and images each story will take,
+# what that costs at list price and how long it should run, without calling the API. Latencies and segment sizes
+# come from earlier runs' metrics.json reports when they are available, and from the defaults below otherwise.
+
+DEFAULT_RATES = {
+    "completion_tokens_per_segment": 1000,  # gpt-4o rarely writes much more per reply, whatever max_tokens allows
+    "chat_seconds": 0.8,                     # Per call, before the first token
+    "chat_seconds_per_token": 0.02,          # About 50 completion tokens per second
+    "speech_seconds": 1.5,
+    "speech_seconds_per_character": 0.0008,
+    "image_seconds": 12.0,
+    "video_seconds": 10.0,
+}
+
+TOKENS_PER_PARAGRAPH = 90        # Typical story paragraph
+NOTES_TOKENS = 600               # Running summary, characters and plot threads once the context starts folding
+NOTES_INSTRUCTION_TOKENS = 150
+INTRO_COMPLETION_TOKENS = 150
+SUMMARY_COMPLETION_TOKENS = 300
+PROGRESS_TOKENS = 60             # Completion percentage, remaining tokens and end-marker offer at the end of the prompt
+
+def load_history(paths):
+    # Calls and stage durations from metrics.json reports written by earlier runs; missing files are skipped
+    calls = []
+    stage_durations = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as report_file:
+            report = json.load(report_file)
+        calls.extend(call for call in report.get("calls", []) if not call.get("error"))
+        for story in report.get("stories", {}).values():
+            for stage, duration in story.get("stages", {}).items():
+                stage_durations.setdefault(stage, []).append(duration)
+    return calls, stage_durations
+
+def fit_line(points):
+    # Least squares intercept and slope for (x, y) points; None when x never varies
+    if len(points) < 3:
+        return None
+    mean_x = statistics.mean(x for x, _ in points)
+    mean_y = statistics.mean(y for _, y in points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    return mean_y - slope * mean_x, slope
+
+def rates_from_history(calls, stage_durations):
+    # Returns the rates and which of them were measured rather than defaulted
+    rates = dict(DEFAULT_RATES)
+    measured = []
+
+    story_calls = [call for call in calls if call["endpoint"] == "chat" and call.get("stage") == "story" and call["model"].startswith("gpt-4o") and not call["model"].startswith("gpt-4o-mini")]
+    # Intros are story-stage calls too but capped at 500 tokens, so the median is the segment size
+    if story_calls:
+        rates["completion_tokens_per_segment"] = statistics.median(call["completion_tokens"] for call in story_calls)
+        measured.append("completion_tokens_per_segment")
+    line = fit_line([(call["completion_tokens"], call["latency"]) for call in story_calls])
+    if line and line[1] > 0:
+        rates["chat_seconds"], rates["chat_seconds_per_token"] = max(line[0], 0.0), line[1]
+        measured += ["chat_seconds", "chat_seconds_per_token"]
+
+    speech_calls = [call for call in calls if call["endpoint"] == "speech" and call.get("characters")]
+    line = fit_line([(call["characters"], call["latency"]) for call in speech_calls])
+    if line and line[1] > 0:
+        rates["speech_seconds"], rates["speech_seconds_per_character"] = max(line[0], 0.0), line[1]
+        measured += ["speech_seconds", "speech_seconds_per_character"]
+
+    image_calls = [call for call in calls if call["endpoint"] == "images"]
+    if image_calls:
+        rates["image_seconds"] = statistics.mean(call["latency"] for call in image_calls)
+        measured.append("image_seconds")
+
+    if stage_durations.get("video"):
+        rates["video_seconds"] = statistics.mean(stage_durations["video"])
+        measured.append("video_seconds")
+    return rates, measured
+
+def plan_story(story_topic, world_detail="", intended_audience="all", total_token_limit=10000, max_tokens_per_call=4095,
+               recent_paragraphs=8, fold_paragraphs=None, image_count=4, tts_model="tts-1", tts_workers=4, image_workers=4, rates=None):
+    rates = rates or DEFAULT_RATES
+    fold_paragraphs = fold_paragraphs or 2 * recent_paragraphs  # StoryContext's default
+
+    def chat_seconds(completion_tokens):
+        return rates["chat_seconds"] + rates["chat_seconds_per_token"] * completion_tokens
+
+    # The parts of the segment prompt that don't depend on the story so far, counted with the real template
+    header_tokens = count_message_tokens(build_messages(build_story_prompt(story_topic, intended_audience, world_detail, "", 0.0, total_token_limit, END_MARKERS), STORY_SYSTEM_PROMPT)) + PROGRESS_TOKENS
+
+    # Walk the same loop generate_story runs: the budget is the story's own length, and the context grows by
+    # whole segments until it folds back to recent_paragraphs with the running notes in front
+    story_tokens = 0
+    segments = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    notes_prompt_tokens = 0
+    notes_completion_tokens = 0
+    story_seconds = 0.0
+    verbatim_paragraphs = 0
+    notes_tokens = 0
+    per_segment = int(min(max_tokens_per_call, rates["completion_tokens_per_segment"]))
+    while story_tokens < total_token_limit:
+        produced = min(per_segment, total_token_limit - story_tokens)
+        prompt_tokens += header_tokens + notes_tokens + verbatim_paragraphs * TOKENS_PER_PARAGRAPH
+        completion_tokens += produced
+        story_tokens += produced
+        story_seconds += chat_seconds(produced)
+        segments += 1
+        verbatim_paragraphs += produced / TOKENS_PER_PARAGRAPH
+        if verbatim_paragraphs >= recent_paragraphs + fold_paragraphs:
+            folded = verbatim_paragraphs - recent_paragraphs
+            notes_prompt_tokens += NOTES_INSTRUCTION_TOKENS + notes_tokens + folded * TOKENS_PER_PARAGRAPH
+            notes_completion_tokens += NOTES_TOKENS
+            story_seconds += chat_seconds(NOTES_TOKENS)
+            verbatim_paragraphs = recent_paragraphs
+            notes_tokens = NOTES_TOKENS
+
+    intro_prompt_tokens = count_message_tokens(build_messages(build_intro_prompt(story_topic, world_detail), INTRO_SYSTEM_PROMPT))
+    prompt_tokens += intro_prompt_tokens
+    completion_tokens += INTRO_COMPLETION_TOKENS
+    story_seconds += chat_seconds(INTRO_COMPLETION_TOKENS)
+
+    # Everything narrated: title, intro, story and the sign-off
+    narrated_tokens = story_tokens + INTRO_COMPLETION_TOKENS + count_tokens(f"Today's story is called '{story_topic}'" + STORY_ENDING)
+    summary_prompt_tokens = count_tokens(SUMMARY_SYSTEM_PROMPT) + narrated_tokens
+    tts_characters = int(narrated_tokens * CHARS_PER_TOKEN)
+    max_length, _ = TTS_INPUT_LIMITS.get(tts_model, TTS_INPUT_LIMITS["tts-1"])
+    tts_segments = max(1, math.ceil(tts_characters / (max_length * 0.9)))
+
+    cost = (chat_cost("gpt-4o", prompt_tokens + summary_prompt_tokens, completion_tokens + SUMMARY_COMPLETION_TOKENS)
+            + chat_cost("gpt-4o-mini", notes_prompt_tokens, notes_completion_tokens)
+            + speech_cost(tts_model, tts_characters)
+            + image_cost("dall-e-3", count=image_count))
+
+    # Same dependency graph as story_stages: story, then summary -> images alongside audio, then video
+    summary_seconds = chat_seconds(SUMMARY_COMPLETION_TOKENS)
+    images_seconds = math.ceil(image_count / max(1, image_workers)) * rates["image_seconds"] if image_count else 0.0
+    speech_seconds = rates["speech_seconds"] + rates["speech_seconds_per_character"] * tts_characters / tts_segments
+    audio_seconds = math.ceil(tts_segments / max(1, tts_workers)) * speech_seconds
+    wall_clock = story_seconds + max(summary_seconds + images_seconds, audio_seconds) + rates["video_seconds"]
+
+    return {
+        "topic": story_topic,
+        "segments": segments,
+        "story_tokens": story_tokens,
+        "prompt_tokens": int(prompt_tokens + summary_prompt_tokens + notes_prompt_tokens),
+        "completion_tokens": int(completion_tokens + SUMMARY_COMPLETION_TOKENS + notes_completion_tokens),
+        "tts_characters": tts_characters,
+        "tts_segments": tts_segments,
+        "images": image_count,
+        "cost": round(cost, 4),
+        "wall_clock_seconds": round(wall_clock, 1),
+        "stage_seconds": {
+            "story": round(story_seconds, 1),
+            "summary": round(summary_seconds, 1),
+            "images": round(images_seconds, 1),
+            "audio": round(audio_seconds, 1),
+            "video": round(rates["video_seconds"], 1),
+        },
+    }
+
+def plan_batch(story_topics, world_details, intended_audience="all", history_paths=(), **options):
+    rates, measured = rates_from_history(*load_history(history_paths))
+    plans = [plan_story(topic, world_details.get(topic, ""), intended_audience, rates=rates, **options) for topic in story_topics]
+    totals = {key: sum(plan[key] for plan in plans) for key in ("segments", "story_tokens", "prompt_tokens", "completion_tokens", "tts_characters", "images", "cost", "wall_clock_seconds")}
+    totals["cost"] = round(totals["cost"], 4)
+    return {"stories": plans, "totals": totals, "rates": rates, "measured_rates": measured}
+
+def log_plan(plan):
+    source = f"measured from past runs: {', '.join(plan['measured_rates'])}" if plan["measured_rates"] else "defaults, no past metrics.json found"
+    logging.info(f"Rates ({source})")
+    for story in plan["stories"] + [dict(plan["totals"], topic="Total (stories run one after another)")]:
+        logging.info(f"{story['topic']}: {story['segments']} segments, {story['story_tokens']} story tokens, "
+                     f"{story['prompt_tokens']} prompt / {story['completion_tokens']} completion tokens, "
+                     f"{story['tts_characters']} TTS characters, {story['images']} images, "
+                     f"${story['cost']:.2f} at list price, about {story['wall_clock_seconds'] / 60:.1f} minutes")
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+# Per-story record of finished work units (story segments, intro, summary, images, TTS segments, ...)
+# so a --resume run can skip everything that already completed and pick up at the first missing unit
+
+MANIFEST_FILENAME = "manifest.json"
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(folder):
+    # One shared instance per story folder, so every stage thread records into the same object
+    path = (Path(folder) / MANIFEST_FILENAME).resolve()
+    with _manifests_lock:
+        if path not in _manifests:
+            _manifests[path] = RunManifest(path)
+        return _manifests[path]
+
+class RunManifest:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.units = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                self.units = json.load(manifest_file).get("units", {})
+
+    def reset(self):
+        with self.lock:
+            self.units = {}
+            self._save()
+
+    def get(self, unit):
+        with self.lock:
+            return self.units.get(unit)
+
+    def is_done(self, unit, expected_hash=None, output_path=None):
+        # Done means recorded, built from the same input (when a hash is given) and its output file still exists
+        entry = self.get(unit)
+        if entry is None:
+            return False
+        if expected_hash is not None and entry.get("hash") != expected_hash:
+            return False
+        if output_path is not None and not Path(output_path).exists():
+            return False
+        return True
+
+    def record(self, unit, content_hash=None, **fields):
+        with self.lock:
+            self.units[unit] = {"hash": content_hash, "completed_at": time.time(), **fields}
+            self._save()
+
+    def _save(self):
+        # Write and rename, so a crash mid-write leaves the previous manifest intact
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"units": self.units}, manifest_file, indent=2)
+        os.replace(temp_path, self.path)
+        logging.debug(f"Manifest saved to {self.path}")
@@ -0,0 +1,113 @@
+import json
+import logging
+from collections import deque
+
+# Compact "story so far" for the continuation prompt: the latest paragraphs verbatim plus a running summary,
+# so the prompt stays about the same size however long the story gets. Paragraphs are folded into the summary in
+# batches of fold_paragraphs rather than one window slide per segment: between folds the rendered context only
+# grows at the end, so consecutive prompts share a long prefix the API can serve from its prompt cache.
+
+class StoryContext:
+    def __init__(self, client, recent_paragraphs=8, summary_model="gpt-4o-mini", summary_max_tokens=800, max_list_items=12, fold_paragraphs=None):
+        self.client = client
+        self.recent_paragraphs = recent_paragraphs
+        self.fold_paragraphs = fold_paragraphs or 2 * recent_paragraphs
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.max_list_items = max_list_items
+        self.recent = deque()
+        self.pending = []
+        self.summary = ""
+        self.characters = []
+        self.plot_threads = []
+        self.tokens_used = 0
+
+    def to_dict(self):
+        return {
+            "recent_paragraphs": self.recent_paragraphs,
+            "fold_paragraphs": self.fold_paragraphs,
+            "recent": list(self.recent),
+            "pending": self.pending,
+            "summary": self.summary,
+            "characters": self.characters,
+            "plot_threads": self.plot_threads,
+            "tokens_used": self.tokens_used,
+        }
+
+    @classmethod
+    def from_dict(cls, client, state):
+        context = cls(client, recent_paragraphs=state["recent_paragraphs"], fold_paragraphs=state.get("fold_paragraphs"))
+        context.recent = deque(state["recent"])
+        context.pending = list(state["pending"])
+        context.summary = state["summary"]
+        context.characters = list(state["characters"])
+        context.plot_threads = list(state["plot_threads"])
+        context.tokens_used = state["tokens_used"]
+        return context
+
+    def add_segment(self, segment_content):
+        paragraphs = [paragraph.strip() for paragraph in segment_content.split("\n\n") if paragraph.strip()]
+        self.recent.extend(paragraphs)
+        if len(self.recent) < self.recent_paragraphs + self.fold_paragraphs:
+            return
+        while len(self.recent) > self.recent_paragraphs:
+            self.pending.append(self.recent.popleft())
+        if self.pending:
+            self.update_summary()
+
+    def update_summary(self):
+        # Folds the paragraphs that just left the verbatim window into the summary; on failure they stay pending for the next try
+        # Fixed instructions go in the system message so every update shares the same cacheable prefix
+        instructions = f"""
+        You maintain the running notes for a story that is still being written. Update the notes with the new passage below.
+        Return a JSON object with the keys "summary" (a few paragraphs covering every chapter so far, in order, keeping chapter titles),
+        "characters" (at most {self.max_list_items} strings of the form "Name: who they are and where they stand now") and
+        "plot_threads" (at most {self.max_list_items} strings, one per unresolved mystery, promise or conflict).
+        """
+        prompt = f"""
+        Current summary: {self.summary or "None yet."}
+        Current characters: {json.dumps(self.characters)}
+        Current plot threads: {json.dumps(self.plot_threads)}
+
+        New passage:
+        {chr(10).join(self.pending)}
+        """
+        try:
+            response = self.client.chat.completions.create(
+                messages=[
+                    {
+                        "role": "system",
+                        "content": instructions,
+                    },
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                model=self.summary_model,
+                max_tokens=self.summary_max_tokens,
+                response_format={"type": "json_object"}
+            )
+            notes = json.loads(response.choices[0].message.content)
+            self.tokens_used += response.usage.total_tokens
+        except Exception as e:
+            logging.error(f"Error while updating the story summary, keeping {len(self.pending)} paragraphs pending: {e}")
+            return
+        self.summary = str(notes.get("summary", self.summary)).strip()
+        self.characters = [str(item) for item in notes.get("characters", self.characters)][:self.max_list_items]
+        self.plot_threads = [str(item) for item in notes.get("plot_threads", self.plot_threads)][:self.max_list_items]
+        self.pending = []
+
+    def render(self):
+        sections = []
+        if self.summary:
+            sections.append(f"Summary of the story so far:\n{self.summary}")
+        if self.characters:
+            sections.append("Characters:\n" + "\n".join(f"- {character}" for character in self.characters))
+        if self.plot_threads:
+            sections.append("Open plot threads:\n" + "\n".join(f"- {thread}" for thread in self.plot_threads))
+        # Paragraphs whose summary update failed are still shown verbatim so nothing drops out of the prompt
+        verbatim = self.pending + list(self.recent)
+        if verbatim:
+            sections.append("Most recent passage, verbatim:\n" + "\n\n".join(verbatim))
+        return "\n\n".join(sections)
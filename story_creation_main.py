@@ -1,71 +1,131 @@
 import logging
-from openai import OpenAI
-import os
-from generate_story import generate_story, generate_summary  # Import the generate_story and generate_summary functions
-from text_to_audio import text_to_audio
+import queue
+import sys
+from generate_story import generate_story, generate_summary, story_folder  # Import the generate_story and generate_summary functions
+from text_to_audio import text_to_audio, paragraphs_to_audio, iter_paragraph_queue
 from audio_to_video import audio_to_video
 from pathlib import Path
-from generate_image import generate_image_from_summary, save_image  # Import the image generation and save functions
-
-def main():
-    # Set up logging configuration for script message logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-    # Retrieve the OpenAI API key from environment variables or set API key here
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        logging.error("API key not found in environment variables.")
-        return
-
-    # Initialize the OpenAI client with the API key
-    client = OpenAI(api_key=api_key)
-
-    # Define story topics and world details
-    story_topics = ["The mysterious Island of Atlantis"] 
-
-    #Define the world details in the format of "title": "World Description"
-    world_details = {"The mysterious Island of Atlantis": "Atlantis is a legendary island first mentioned in Plato's dialogues Timaeus and Critias, written about 360 BC. According to Plato, Atlantis was a naval power lying beyond the Pillars of Hercules that conquered many parts of Western Europe and Africa 9,000 years before the time of Solon, or approximately 9600 BC. After a failed attempt to invade Athens, Atlantis sank into the ocean in a single day and night of misfortune . The island was said to be larger than Asia and Libya combined, and was the home of a technologically advanced civilization. The story of Atlantis has captivated the imagination of people for centuries, with many theories and speculations about its possible location and existence."}
-
-
-    # Step 1: Generate the stories, specifying the audience of the story as appropriate ex/ "all", "children", "adults"
-    logging.info("The story creation process has begun, please wait... this may take a few minutes")
-    generated_story_paths, total_cost = generate_story(api_key, story_topics, world_details, intended_audience="all")
-
-    # Display the total cost
-    logging.info(f"Total cost for generating all stories: ${total_cost:.2f}")
-
-    # Step 2: Generate and save images based on the story
-    for story_path in generated_story_paths:
-        with open(story_path, "r", encoding="utf-8") as file:
-            story = file.read()
-
+from generate_image import generate_images_from_summary, thumbnail_path, THUMBNAIL_SIZE  # Import the image generation and save functions
+from pipeline import Stage
+from clean_story_text import clean_story_file, iter_clean_paragraphs
+from metrics import instrument
+from run_manifest import load_manifest, content_hash, file_hash
+
+def generate_images(client, story_path, summary, image_count=4, manifest=None):
+    # Generate X amount of images to use from summary, all at once, plus a 1280x720 thumbnail of each
+    audio_filename = Path(story_path).stem
+    output_dir = Path(story_path).parent
+    image_save_paths = [output_dir / f"{audio_filename}_image_{i}.png" for i in range(1, image_count + 1)]
+    summary_hash = content_hash(summary)
+    if manifest is not None:
+        missing_paths = [path for i, path in enumerate(image_save_paths, 1) if not manifest.is_done(f"image/{i}", summary_hash, path)]
+    else:
+        missing_paths = image_save_paths
+    for path in generate_images_from_summary(client, summary, missing_paths, thumbnail_size=THUMBNAIL_SIZE):
+        if path and manifest is not None:
+            manifest.record(f"image/{image_save_paths.index(path) + 1}", summary_hash, path=str(path))
+    return [path for path in image_save_paths if path.exists()]
+
+def read_story_file(story_path):
+    with open(story_path, "r", encoding="utf-8") as file:
+        return file.read()
+
+def story_stages(client, api_key, story_topic, world_details, intended_audience="all", resume=False, stream_audio=False, total_token_limit=10000, max_tokens_per_call=4095, tts_cache_dir=None, tts_requests_per_minute=None):
+    client = instrument(client, story=story_topic)
+    # With stream_audio, the audio stage starts with the story and narrates paragraphs as soon as they are written.
+    # tts_cache_dir shares one TTS cache across stories; without it each story folder keeps its own.
+    # tts_requests_per_minute caps the speech calls below the account limit
+    paragraph_queue = queue.Queue() if stream_audio else None
+
+    def stage_client(stage):
+        # Calls are labelled with the story and the stage that made them, for the per-story cost report
+        return client.with_labels(stage=stage)
+
+    # story -> summary -> images and story -> clean -> audio, then video once story, images and audio are all done; the
+    # image branch runs alongside TTS, and a failed image call leaves the video with a black frame instead of failing it
+    # Every stage checks the story's run manifest first, so a resumed run only redoes unfinished work
+    def story(results):
+        try:
+            generated_story_paths, total_cost = generate_story(api_key, [story_topic], world_details, intended_audience=intended_audience, max_tokens_per_call=max_tokens_per_call, total_token_limit=total_token_limit, resume=resume, client=stage_client("story"), paragraph_queue=paragraph_queue)
+        except Exception as e:
+            if paragraph_queue is not None:
+                paragraph_queue.put(e)
+            raise
+        if paragraph_queue is not None:
+            paragraph_queue.put(None)
+        # Display the total cost
+        logging.info(f"Total cost for generating '{story_topic}': ${total_cost:.2f}")
+        return generated_story_paths[0]
+
+    def manifest(results):
+        return load_manifest(Path(results["story"]).parent)
+
+    def summary(results):
         # Generate summary of the story
-        summary, _ = generate_summary(client, story)
-
-
-        for i in range(1, 5):
-            # Generate X amount of images to use from summary
-            image_url, _ = generate_image_from_summary(client, summary)
-            logging.info(f"Generated image URL: {image_url}")
-
-            # Define image save path
-            audio_filename = Path(story_path).stem
-            output_dir = Path(story_path).parent
-            image_save_path = output_dir / f"{audio_filename}_image_{i}.png"
-            save_image(image_url, image_save_path)
-            logging.info(f"Image saved to {image_save_path}")
-
-        # Step 3: Convert each generated story text to audio
-        final_audio_path = text_to_audio(client, story_path)
-        logging.info(f"Story creation and conversion to audio completed successfully for {story_path}. Final audio file is located at: {final_audio_path}")
-        
-        # Step 4: Convert each generated audio to video
-        audio_file = Path(final_audio_path)
-        video_filename = audio_file.stem + '.mp4'
-        output_video_path = output_dir / video_filename
-
-        audio_to_video(str(audio_file), str(output_video_path))
+        story_text = read_story_file(results["story"])
+        story_hash = content_hash(story_text)
+        if manifest(results).is_done("summary", story_hash):
+            return manifest(results).get("summary")["text"]
+        summary_text, _ = generate_summary(stage_client("summary"), story_text)
+        if summary_text:
+            manifest(results).record("summary", story_hash, text=summary_text)
+        return summary_text
+
+    def images(results):
+        try:
+            return generate_images(stage_client("images"), results["story"], results["summary"], manifest=manifest(results))
+        except Exception as e:
+            logging.error(f"Image generation failed for '{story_topic}', the video gets a black frame: {e}")
+            return []
+
+    def clean(results):
+        # Strip markdown and "Segment N" artifacts so they are not read aloud
+        story_path = Path(results["story"])
+        return clean_story_file(story_path, story_path.with_name(f"{story_path.stem}_cleaned.txt"))
+
+    def audio(results):
+        if paragraph_queue is not None:
+            # Runs alongside the story stage, cleaning and synthesizing each paragraph as generate_story finishes it
+            story_dir = Path(story_folder(story_topic))
+            paragraphs = iter_clean_paragraphs(iter_paragraph_queue(paragraph_queue))
+            final_audio_path = paragraphs_to_audio(stage_client("audio"), paragraphs, story_dir, cache_dir=tts_cache_dir, requests_per_minute=tts_requests_per_minute, manifest=load_manifest(story_dir))
+            logging.info(f"Story narration completed while it was written. Final audio file is located at: {final_audio_path}")
+            return final_audio_path
+        final_audio_path = text_to_audio(stage_client("audio"), results["clean"], cache_dir=tts_cache_dir, requests_per_minute=tts_requests_per_minute, manifest=manifest(results), output_dir=Path(results["story"]).parent)
+        logging.info(f"Story creation and conversion to audio completed successfully for {results['story']}. Final audio file is located at: {final_audio_path}")
+        return final_audio_path
+
+    def video(results):
+        audio_file = Path(results["audio"])
+        output_video_path = Path(results["story"]).parent / (audio_file.stem + '.mp4')
+        # The first generated thumbnail becomes the still frame, black if no image was made
+        thumbnails = [thumbnail_path(path) for path in results["images"] if thumbnail_path(path).exists()]
+        image_file = thumbnails[0] if thumbnails else None
+        video_hash = content_hash(f"{file_hash(audio_file)} {file_hash(image_file) if image_file else 'black'}")
+        if manifest(results).is_done("video", video_hash, output_video_path):
+            logging.info(f"Video is up to date, skipping: {output_video_path}")
+            return output_video_path
+        chapters_file = audio_file.with_name(f"{audio_file.stem}_chapters.ffmetadata")
+        audio_to_video(str(audio_file), str(output_video_path), image_file=image_file, chapters_file=chapters_file if chapters_file.exists() else None)
+        if output_video_path.exists():
+            manifest(results).record("video", video_hash, path=str(output_video_path))
         logging.info(f"Audio to video conversion completed successfully for {audio_file}. Final video file is located at: {output_video_path}")
+        return output_video_path
+
+    return [
+        Stage("story", story),
+        Stage("summary", summary, depends_on=["story"]),
+        Stage("images", images, depends_on=["summary"]),
+        Stage("clean", clean, depends_on=["story"]),
+        Stage("audio", audio, depends_on=[] if stream_audio else ["clean"]),
+        # story too: with stream_audio the audio stage doesn't depend on it, but the video reads its path
+        Stage("video", video, depends_on=["story", "images", "audio"]),
+    ]
+
+def main():
+    # Kept for existing scripts and habits: same as `python cli.py all`, with the same options
+    from cli import main as cli_main
+    return cli_main(["all", *sys.argv[1:]])
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
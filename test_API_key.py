@@ -1,10 +1,10 @@
 import logging
-from openai import OpenAI
+from openai_client import get_client
 
 #small script to make sure that your openAI api key works
 
 def setup_openai_client(api_key: str):
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
     return client
 
 def test_openai_key(client):
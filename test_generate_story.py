@@ -0,0 +1,52 @@
+import unittest
+from types import SimpleNamespace
+
+from generate_story import END_MARKERS, has_end_marker, stream_story_segment
+
+# End marker detection on finished segments and on streamed deltas. Run with: python -m unittest
+
+class FakeStream:
+    # Chat completion stream of the given deltas; counts how many were read before the stream was closed
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.read = 0
+
+    def __iter__(self):
+        for delta in self.deltas:
+            self.read += 1
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+    def close(self):
+        pass
+
+def stream(deltas):
+    response_stream = FakeStream(deltas)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: response_stream)))
+    content, _, _ = stream_story_segment(client, "prompt", stop_markers=END_MARKERS)
+    return content, response_stream.read
+
+class EndMarkers(unittest.TestCase):
+    def test_markers_that_end_the_story(self):
+        for text in ["The End.", "the story. The End", "The End\n", "The End\n\nAfterword", "**The End**", "THE END.", "The end!",
+                     "<END OF STORY>", "x<END OF STORY>y", "<end of story>"]:
+            with self.subTest(text=text):
+                self.assertTrue(has_end_marker(text, END_MARKERS))
+
+    def test_phrases_that_do_not(self):
+        for text in ["The Endless Sea", "At The End of days they sailed", "Bend The Ending", "THE ENDLESS", "they fought to the end.", ""]:
+            with self.subTest(text=text):
+                self.assertFalse(has_end_marker(text, END_MARKERS))
+
+    def test_stream_keeps_going_past_a_longer_word(self):
+        # "The End" split from "less" across deltas must not close the stream
+        content, read = stream(["Once ", "upon The End", "less Sea was calm. ", "The End", ".", " extra", " more"])
+        self.assertEqual(content, "Once upon The Endless Sea was calm. The End.")
+        self.assertEqual(read, 5)
+
+    def test_stream_stops_at_a_marker_on_its_own_line(self):
+        content, read = stream(["And so it was. THE END", "\n", "\nAfterword: thanks", " for reading."])
+        self.assertEqual(read, 2)
+        self.assertTrue(has_end_marker(content, END_MARKERS))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import random
+import re
+import unittest
+
+from clean_story_text import clean_story_text, iter_clean_paragraphs
+from text_to_audio import TTS_INPUT_LIMITS, estimate_tokens, iter_paragraphs, iter_text_segments, split_text_into_segments
+from chapters import is_chapter_heading
+
+# Property checks for the segmenter and the cleaner over seeded random documents: every seed is a different
+# document, and a failure names the seed so it can be replayed. Run with: python -m unittest (or python -m pytest)
+
+SEEDS = range(200)
+SENTENCE_ENDS = [".", ".", ".", "!", "?", "…", ".”", "?'", "!)"]
+CLAUSE_ENDS = [",", ";", ":", " —", " -", " –"]
+PARAGRAPH_BREAKS = ["\n\n", "\n\n", "\n\n\n", "\n \n", "\n\t\n"]
+
+def random_word(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyzéü") for _ in range(rng.randint(1, 12)))
+
+def random_sentence(rng, max_words=25):
+    words = [random_word(rng) for _ in range(rng.randint(1, max_words))]
+    for index in range(len(words) - 1):
+        if rng.random() < 0.1:
+            words[index] += rng.choice(CLAUSE_ENDS)
+    return " ".join(words).capitalize() + rng.choice(SENTENCE_ENDS)
+
+def random_paragraph(rng):
+    kind = rng.random()
+    if kind < 0.05:
+        # A run-on paragraph with no sentence or clause breaks, so only the word split can shorten it
+        return " ".join(random_word(rng) for _ in range(rng.randint(50, 400)))
+    if kind < 0.1:
+        return f"CHAPTER {rng.randint(1, 20)}: {random_word(rng).upper()}"
+    sentences = [random_sentence(rng) for _ in range(rng.randint(1, 12))]
+    # Now and then a line break inside the paragraph, which is not a paragraph break
+    return " ".join(sentence + ("\n" if rng.random() < 0.05 else "") for sentence in sentences).replace("\n ", "\n")
+
+def random_document(rng):
+    paragraphs = [random_paragraph(rng) for _ in range(rng.randint(0, 40))]
+    text = "".join(paragraph + rng.choice(PARAGRAPH_BREAKS) for paragraph in paragraphs)
+    return rng.choice(["", "\n", "  "]) + text
+
+def random_limit(rng):
+    # Small limits make every document split at every level; the real ones are in the mix too
+    max_length, length = rng.choice([(40, len), (80, len), (300, len), (80, estimate_tokens)] + list(TTS_INPUT_LIMITS.values()))
+    return max_length, length
+
+def words(text):
+    return text.split()
+
+class SegmenterProperties(unittest.TestCase):
+    def check_segments(self, segments, text, max_length, length):
+        for segment in segments:
+            self.assertTrue(segment.strip(), "empty segment")
+            self.assertEqual(segment, segment.strip(), "segment with leading or trailing whitespace")
+            self.assertLessEqual(length(segment), max_length, f"segment over the limit: {segment!r}")
+        self.assertEqual(words(" ".join(segments)), words(text), "word sequence changed")
+
+    def test_whole_text(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                text = random_document(rng)
+                max_length, length = random_limit(rng)
+                self.check_segments(split_text_into_segments(text, max_length, length), text, max_length, length)
+
+    def test_paragraphs_as_they_arrive(self):
+        # The streaming path gets an iterable of paragraphs and no total to even the segments out with
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                text = random_document(rng)
+                max_length, length = random_limit(rng)
+                segments = list(iter_text_segments(iter_paragraphs(text), max_length, length=length))
+                self.check_segments(segments, text, max_length, length)
+
+    def test_chapters_start_a_segment(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                text = random_document(rng)
+                max_length, length = random_limit(rng)
+                segments = split_text_into_segments(text, max_length, length, break_before=is_chapter_heading)
+                self.check_segments(segments, text, max_length, length)
+                headings = [paragraph for paragraph in iter_paragraphs(text) if is_chapter_heading(paragraph)]
+                chapter_starts = [segment for segment in segments if is_chapter_heading(segment)]
+                self.assertEqual(len(chapter_starts), len(headings))
+                for segment, heading in zip(chapter_starts, headings):
+                    self.assertTrue(segment.startswith(heading), f"{heading!r} does not start its segment")
+                for segment in segments:
+                    self.assertFalse(any(is_chapter_heading(paragraph) for paragraph in segment.split("\n\n")[1:]), "heading inside a segment")
+
+    def test_oversized_word_is_cut_without_losing_characters(self):
+        for seed in range(50):
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                max_length = rng.randint(5, 50)
+                text = " ".join(random_word(rng) * rng.randint(1, 20) for _ in range(rng.randint(1, 20)))
+                segments = split_text_into_segments(text, max_length)
+                self.assertTrue(all(segment and len(segment) <= max_length for segment in segments))
+                self.assertEqual("".join(words(" ".join(segments))), "".join(words(text)))
+
+    def test_blank_text_has_no_segments(self):
+        for text in ["", " ", "\n\n", " \n\t\n "]:
+            self.assertEqual(split_text_into_segments(text), [])
+
+# Markup the story model leaves in its output, with the words each one should leave behind after cleaning
+def random_markup_paragraph(rng, chapters):
+    kind = rng.random()
+    if kind < 0.1:
+        number = rng.randint(1, 5)
+        title = [random_word(rng) for _ in range(rng.randint(1, 3))]
+        heading = f"CHAPTER {number}: {' '.join(title)}".upper()
+        expected = [] if heading in chapters else words(heading)
+        chapters.add(heading)
+        marked_title = " ".join(f"**{word}**" if rng.random() < 0.3 else word for word in title)
+        return rng.choice(["", "## ", "# "]) + f"{rng.choice(['CHAPTER', 'Chapter', 'chapter'])} {number}: {marked_title}", expected
+    if kind < 0.15:
+        return f"Segment {rng.randint(1, 30)}", []
+    if kind < 0.2:
+        return rng.choice(["- - -", "---", "#"]), []
+    paragraph_words = []
+    expected = []
+    for _ in range(rng.randint(1, 60)):
+        word = random_word(rng)
+        roll = rng.random()
+        if roll < 0.05:
+            # A hyphenated word reads as two words once the dash is gone
+            second = random_word(rng)
+            paragraph_words.append(f"{word}-{second}")
+            expected += [word, second]
+            continue
+        if roll < 0.1:
+            paragraph_words.append(f"*{word}*" if roll < 0.075 else f"**{word}**")
+        else:
+            paragraph_words.append(word)
+        expected.append(word)
+    return " ".join(paragraph_words) + ".", expected[:-1] + [expected[-1] + "."]
+
+def random_markup_document(rng):
+    chapters = set()
+    paragraphs, expected = [], []
+    for _ in range(rng.randint(0, 30)):
+        paragraph, paragraph_expected = random_markup_paragraph(rng, chapters)
+        paragraphs.append(paragraph)
+        expected += paragraph_expected
+    return paragraphs, expected
+
+class CleanerProperties(unittest.TestCase):
+    def test_plain_prose_is_unchanged(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                # Dashes are markup to the cleaner, so the prose here has none
+                text = re.sub(r"\s*[-–—]", "", random_document(rng))
+                cleaned = clean_story_text(text)
+                self.assertEqual(words(cleaned), words(text))
+                self.assertEqual(cleaned, cleaned.strip())
+
+    def test_markup_is_removed_and_words_kept(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                paragraphs, expected = random_markup_document(rng)
+                cleaned = clean_story_text("\n\n".join(paragraphs))
+                self.assertEqual(words(cleaned), expected)
+                self.assertNotIn("*", cleaned)
+                self.assertNotIn("#", cleaned)
+                self.assertIsNone(re.search(r"Segment \d+", cleaned, re.IGNORECASE))
+
+    def test_cleaning_twice_changes_nothing(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                paragraphs, _ = random_markup_document(rng)
+                cleaned = clean_story_text("\n\n".join(paragraphs))
+                self.assertEqual(clean_story_text(cleaned), cleaned)
+
+    def test_paragraph_stream_matches_whole_text(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                paragraphs, expected = random_markup_document(rng)
+                cleaned_paragraphs = list(iter_clean_paragraphs(paragraphs))
+                self.assertTrue(all(paragraph.strip() for paragraph in cleaned_paragraphs), "empty paragraph")
+                self.assertEqual(words(" ".join(cleaned_paragraphs)), expected)
+
+    def test_cleaned_then_segmented_keeps_every_word(self):
+        # The audio stage's path: clean the story, then split it for speech
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                paragraphs, expected = random_markup_document(rng)
+                max_length, length = random_limit(rng)
+                segments = split_text_into_segments(clean_story_text("\n\n".join(paragraphs)), max_length, length, break_before=is_chapter_heading)
+                self.assertTrue(all(segment.strip() and length(segment) <= max_length for segment in segments))
+                self.assertEqual(words(" ".join(segments)), expected)
+
+if __name__ == "__main__":
+    unittest.main()
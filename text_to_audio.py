@@ -1,9 +1,15 @@
 import os
+import re
+import math
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from openai import OpenAI
-from pydub import AudioSegment
+from openai_client import get_client, RateLimiter
+import mp3_frames
+from tts_cache import TTSCache, DEFAULT_MAX_BYTES
+from metrics import speech_cost
+from chapters import is_chapter_heading, build_chapters, write_chapter_files
 
 def read_text_file(file_path):
     try:
@@ -16,74 +22,293 @@ def read_text_file(file_path):
         logging.error(f"An error occurred while reading the file: {e}")
         raise
 
-def split_text_into_segments(input_text, max_chars=4000):
-    segments = []
-    current_segment = ""
-    paragraphs = input_text.split("\n\n")  # Split by paragraphs
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"[.!?\u2026]+[\"'\u201d\u2019)\]]*\s+")
+CLAUSE_END = re.compile(r"[,;:\u2013\u2014]\s+|\s+-+\s+")
+WHITESPACE = re.compile(r"\s+")
+
+def estimate_tokens(text):
+    # Deliberately high (about 3 bytes per token) so a token-limited model is never sent too much
+    return len(text.encode("utf-8")) // 3 + 1
+
+# Speech requests per minute for a client that brings no rate limiter of its own
+DEFAULT_TTS_REQUESTS_PER_MINUTE = 50
+
+# Input limits of the speech models, with the measure each one is limited by
+TTS_INPUT_LIMITS = {
+    "tts-1": (4096, len),
+    "tts-1-hd": (4096, len),
+    "gpt-4o-mini-tts": (2000, estimate_tokens),
+}
+
+def iter_paragraphs(input_text):
+    start = 0
+    for match in PARAGRAPH_BREAK.finditer(input_text):
+        paragraph = input_text[start:match.start()].strip()
+        if paragraph:
+            yield paragraph
+        start = match.end()
+    paragraph = input_text[start:].strip()
+    if paragraph:
+        yield paragraph
+
+def split_after(text, pattern):
+    # Splits after each match, keeping the punctuation with the piece it ends
+    start = 0
+    for match in pattern.finditer(text):
+        piece = text[start:match.end()].strip()
+        if piece:
+            yield piece
+        start = match.end()
+    piece = text[start:].strip()
+    if piece:
+        yield piece
+
+def split_oversized(text, max_length, length=len, patterns=(SENTENCE_END, CLAUSE_END, WHITESPACE)):
+    # Sentence boundaries first, then clauses, then words, and a hard cut only for a single oversized word
+    if length(text) <= max_length:
+        yield text
+    elif not patterns:
+        for start in range(0, len(text), max_length):
+            yield text[start:start + max_length]
+    else:
+        for piece in split_after(text, patterns[0]):
+            yield from split_oversized(piece, max_length, length, patterns[1:])
+
+def iter_text_segments(input_text, max_length=4000, target_length=None, length=len, fill=0.9, break_before=None):
+    # input_text is either the whole text or an iterable of paragraphs (e.g. still arriving from generation).
+    # Every piece is measured once and joined once, so the work is linear in the input size.
+    # break_before(paragraph) returning True starts a new segment at that paragraph, e.g. at chapter headings.
+    remaining = None
+    if isinstance(input_text, str):
+        paragraphs = iter_paragraphs(input_text)
+        if target_length is None:
+            remaining = length(input_text)
+    else:
+        paragraphs = input_text
+
+    def next_target():
+        # With the total known, spread what is left evenly over the segments it still needs, so parallel
+        # synthesis finishes evenly instead of waiting on one long segment next to a short straggler
+        if remaining is None:
+            return min(target_length or max_length, max_length)
+        segments_left = max(1, math.ceil(remaining / (max_length * fill)))
+        return min(math.ceil(remaining / segments_left), max_length)
+
+    target = next_target()
+    parts = []
+    size = 0
     for paragraph in paragraphs:
-        if len(current_segment) + len(paragraph) + 2 <= max_chars:  # +2 for the double newline
-            current_segment += paragraph + "\n\n"
-        else:
-            segments.append(current_segment.strip())
-            current_segment = paragraph + "\n\n"
-    if current_segment:
-        segments.append(current_segment.strip())
-    return segments
-
-def transcribe_text_to_audio(client, text, output_path):
+        joiner = "\n\n"
+        if parts and break_before is not None and break_before(paragraph):
+            yield "".join(parts)
+            if remaining is not None:
+                remaining -= size + length(joiner)
+                target = next_target()
+            parts = []
+            size = 0
+        for piece in split_oversized(paragraph, max_length, length):
+            added = length(piece) + (length(joiner) if parts else 0)
+            overshoot = size + added - target
+            # Close the segment when the piece doesn't fit, or when stopping short lands nearer the target than going over
+            if parts and (size + added > max_length or (overshoot > 0 and overshoot > target - size)):
+                yield "".join(parts)
+                if remaining is not None:
+                    remaining -= size + length(joiner)
+                    target = next_target()
+                parts = []
+                size = 0
+                added = length(piece)
+            if parts:
+                parts.append(joiner)
+            parts.append(piece)
+            size += added
+            joiner = " "
+    if parts:
+        yield "".join(parts)
+
+def split_text_into_segments(input_text, max_chars=4000, length=len, break_before=None):
+    return list(iter_text_segments(input_text, max_chars, length=length, break_before=break_before))
+
+def transcribe_text_to_audio(client, text, output_path, model="tts-1", voice="fable", response_format="mp3", cache=None, rate_limiter=None):
+    if cache is not None:
+        cache_key = TTSCache.key(text, model, voice, response_format)
+        if cache.get(cache_key, response_format, output_path):
+            logging.info(f"Segment restored from cache to {output_path}")
+            return 0  # Nothing was billed for this segment
+    if rate_limiter is not None:
+        rate_limiter.acquire(model)
     response = client.audio.speech.create(
-        model="tts-1",
-        voice="fable",
-        input=text
+        model=model,
+        voice=voice,
+        input=text,
+        response_format=response_format
     )
     with open(output_path, "wb") as audio_file:
         audio_file.write(response.read())
+    if cache is not None:
+        cache.put(cache_key, response_format, output_path)
     logging.info(f"Segment saved to {output_path}")
     return len(text)  # Return the number of characters instead of tokens
 
-def stitch_audio_segments(audio_paths, output_path):
-    combined = AudioSegment.silent(duration=1000)  # Initial silence
+def speech_rate_limiter(client, model, requests_per_minute=None):
+    # The shared client's limiter paces speech like every other call; requests_per_minute caps the speech model in it
+    # below the account limit. A client without one (a raw OpenAI client, a fake) gets a limiter of its own here.
+    # Returns the limiter transcribe_text_to_audio has to wait on itself, None when the client does it
+    shared_limiter = getattr(client, "limiter", None)
+    if isinstance(shared_limiter, RateLimiter):
+        if requests_per_minute:
+            shared_limiter.cap_requests(model, requests_per_minute)
+        return None
+    return RateLimiter(requests_per_minute or DEFAULT_TTS_REQUESTS_PER_MINUTE)
+
+def transcribe_segments(client, segments, output_dir, max_workers=4, cache=None, manifest=None, model="tts-1", voice="fable", requests_per_minute=None):
+    # segments can be a list or a generator still being fed by story generation; each one is submitted as soon as it arrives
+    rate_limiter = speech_rate_limiter(client, model, requests_per_minute)
+
+    def transcribe(index, segment):
+        audio_path = output_dir / f"segment_{index+1}.mp3"
+        unit = f"tts/segment_{index+1}"
+        segment_hash = TTSCache.key(segment, model, voice, "mp3")
+        if manifest is not None and manifest.is_done(unit, segment_hash, audio_path):
+            logging.info(f"Segment {index+1} already synthesized, skipping")
+            return audio_path, 0, None
+        start_time = time.time()
+        chars_used = transcribe_text_to_audio(client, segment, audio_path, model, voice, cache=cache, rate_limiter=rate_limiter)
+        latency = time.time() - start_time
+        if manifest is not None:
+            manifest.record(unit, segment_hash, path=str(audio_path))
+        logging.info(f"Segment {index+1} synthesized in {latency:.2f} seconds ({chars_used} characters)")
+        return audio_path, chars_used, latency
+
+    # Results are collected in submission order, so the paths stay in story order however the calls finish
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(transcribe, index, segment) for index, segment in enumerate(segments)]
+        results = [future.result() for future in futures]
+
+    audio_paths = [audio_path for audio_path, _, _ in results]
+    total_chars = sum(chars_used for _, chars_used, _ in results)
+    latencies = [latency for _, _, latency in results if latency is not None]
+    return audio_paths, total_chars, latencies
+
+def stitch_audio_segments(audio_paths, output_path, silence_ms=1000):
+    # Joins the segments frame by frame with silent frames in between, no decode or re-encode
+    first_frames = [mp3_frames.probe(path) for path in audio_paths]
+    formats = {(header.version, header.sample_rate, header.channels) if header else None for header in first_frames}
+    if len(formats) != 1 or None in formats:
+        logging.info("Audio segment formats differ, falling back to a full decode and re-encode")
+        return stitch_audio_segments_pydub(audio_paths, output_path, silence_ms)
+
+    first = first_frames[0]
+    silence = mp3_frames.silence(first.version, first.bitrate, first.sample_rate, first.channels, silence_ms)
+    silence_seconds = mp3_frames.silence_duration(first.version, first.sample_rate, silence_ms)
+    # Where each segment starts in the final audio, counted from the frame headers as they are copied
+    segment_starts = []
+    position = 0.0
+    with open(output_path, "wb") as output_file:
+        output_file.write(silence)  # Initial silence
+        position += silence_seconds
+        for path in audio_paths:
+            segment_starts.append(position)
+            for header, frame in mp3_frames.iter_frames(path):
+                output_file.write(frame)
+                position += header.samples / header.sample_rate
+            output_file.write(silence)  # Add silence between segments
+            position += silence_seconds
+    logging.info(f"Final audio saved to {output_path}")
+    return segment_starts, position
+
+def stitch_audio_segments_pydub(audio_paths, output_path, silence_ms=1000):
+    from pydub import AudioSegment  # Only the fallback decodes audio, so pydub loads only when it is needed
+
+    combined = AudioSegment.silent(duration=silence_ms)  # Initial silence
+    segment_starts = []
     for path in audio_paths:
+        segment_starts.append(len(combined) / 1000)
         segment = AudioSegment.from_mp3(path)
-        combined += segment + AudioSegment.silent(duration=1000)  # Add silence between segments
+        combined += segment + AudioSegment.silent(duration=silence_ms)  # Add silence between segments
     combined.export(output_path, format="mp3")
     logging.info(f"Final audio saved to {output_path}")
+    return segment_starts, len(combined) / 1000
 
-def text_to_audio(client, text_file_path):
-    foldername = os.path.splitext(os.path.basename(text_file_path))[0]
-    output_dir = Path(foldername)
-    output_dir.mkdir(exist_ok=True)
+def text_to_audio(client, text_file_path, max_workers=4, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, manifest=None, model="tts-1", voice="fable", output_dir=None, requests_per_minute=None):
+    # Audio goes to a folder named after the text file unless output_dir is given; the final MP3 is named after the folder
+    if output_dir is None:
+        output_dir = os.path.splitext(os.path.basename(text_file_path))[0]
 
     # Read the input text
     input_text = read_text_file(text_file_path)
     logging.info(f"Read input text from {text_file_path}")
 
-    # Split the text into segments
-    segments = split_text_into_segments(input_text)
+    # Split the text into segments that fit the speech model's input limit
+    max_length, length = TTS_INPUT_LIMITS.get(model, TTS_INPUT_LIMITS["tts-1"])
+    # Chapters start on a segment of their own, so their timestamps fall exactly on a segment boundary
+    segments = split_text_into_segments(input_text, max_length, length, break_before=is_chapter_heading)
     logging.info(f"Split input text into {len(segments)} segments")
 
+    return segments_to_audio(client, segments, output_dir, max_workers, cache_dir, cache_max_bytes, manifest, model, voice, requests_per_minute)
+
+def paragraphs_to_audio(client, paragraphs, output_dir, max_workers=4, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, manifest=None, model="tts-1", voice="fable", requests_per_minute=None):
+    # Streaming variant of text_to_audio: paragraphs is an iterable that may still be growing (see iter_paragraph_queue),
+    # and each segment is synthesized as soon as enough paragraphs have arrived to fill it
+    max_length, length = TTS_INPUT_LIMITS.get(model, TTS_INPUT_LIMITS["tts-1"])
+    segments = iter_text_segments(paragraphs, max_length, length=length, break_before=is_chapter_heading)
+    return segments_to_audio(client, segments, output_dir, max_workers, cache_dir, cache_max_bytes, manifest, model, voice, requests_per_minute)
+
+def iter_paragraph_queue(paragraph_queue):
+    # Yields paragraphs put on the queue by generate_story until the producer puts None; an exception put on the
+    # queue means generation failed, and is raised here so no audio is stitched from half a story
+    while True:
+        item = paragraph_queue.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise RuntimeError("Story generation failed while its audio was being synthesized") from item
+        yield item
+
+def segments_to_audio(client, segments, output_dir, max_workers=4, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, manifest=None, model="tts-1", voice="fable", requests_per_minute=None):
+    output_dir = Path(output_dir)
+    foldername = output_dir.name
+    output_dir.mkdir(exist_ok=True)
+
+    # Each story keeps its own cache unless a shared cache_dir is passed in
+    cache = TTSCache(cache_dir or output_dir / ".tts_cache", cache_max_bytes)
+
     start_time = time.time()
-    total_chars = 0
 
-    # Transcribe each segment to an MP3 file
-    audio_paths = []
-    for i, segment in enumerate(segments):
-        segment_path = output_dir / f"segment_{i+1}.mp3"
-        chars_used = transcribe_text_to_audio(client, segment, segment_path)
-        audio_paths.append(segment_path)
-        total_chars += chars_used
+    # The segment texts are kept for the chapter index; a generator is consumed as it goes
+    segment_texts = []
+
+    def keep_text(segments):
+        for segment in segments:
+            segment_texts.append(segment)
+            yield segment
+
+    # Transcribe the segments to MP3 files, up to max_workers at a time
+    audio_paths, total_chars, latencies = transcribe_segments(client, keep_text(segments), output_dir, max_workers, cache, manifest, model, voice, requests_per_minute)
+    synthesis_time = time.time() - start_time
 
     # Stitch all audio segments together
     final_output_path = output_dir / f"{foldername}.mp3"
-    stitch_audio_segments(audio_paths, final_output_path)
+    segment_starts, total_seconds = stitch_audio_segments(audio_paths, final_output_path)
+
+    # Chapter markers from where each heading's segment landed, with no decode of the final audio
+    chapters = build_chapters(segment_texts, segment_starts, total_seconds)
+    chapter_paths = write_chapter_files(chapters, output_dir / foldername)
+    if manifest is not None:
+        manifest.record("audio", path=str(final_output_path), chapters=[str(path) for path in chapter_paths])
 
     end_time = time.time()
     total_time = end_time - start_time
-    total_cost = (total_chars / 1000) * 0.015
+    total_cost = speech_cost(model, total_chars)
 
     logging.info(f"Process completed successfully")
-    logging.info(f"Total character usage: {total_chars}")
+    logging.info(f"Total character usage: {total_chars} over {len(audio_paths)} segments")
+    logging.info(cache.summary())
     logging.info(f"Total cost: ${total_cost:.6f}")
+    if latencies:
+        logging.info(f"Segment latency: min {min(latencies):.2f}s, mean {sum(latencies) / len(latencies):.2f}s, max {max(latencies):.2f}s")
+        logging.info(f"Synthesis took {synthesis_time:.2f} seconds with {max_workers} workers, {sum(latencies) / max(synthesis_time, 1e-9):.2f}x speedup over serial")
     logging.info(f"Total time taken: {total_time:.2f} seconds")
 
     return final_output_path
@@ -94,6 +319,6 @@ if __name__ == "__main__":
     if not api_key:
         logging.error("API key not found in environment variables.")
         exit(1)
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
     text_file_path = "generated_story.txt" 
     text_to_audio(client, text_file_path)
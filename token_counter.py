@@ -0,0 +1,34 @@
+import functools
+import logging
+
+# Local prompt token counts, before a call is made. Uses tiktoken when it is installed; otherwise a character
+# heuristic that is close enough for English prose (about 4 characters per token) and never loads anything.
+
+CHARS_PER_TOKEN = 4.0
+
+# Chat formatting overhead the API adds around each message and to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+@functools.lru_cache(maxsize=None)
+def encoding_for(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logging.info(f"tiktoken has no encoding for {model}, using o200k_base")
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text, model="gpt-4o"):
+    if not text:
+        return 0
+    encoding = encoding_for(model)
+    if encoding is None:
+        return int(len(text) / CHARS_PER_TOKEN) + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model="gpt-4o"):
+    return sum(TOKENS_PER_MESSAGE + count_tokens(str(message.get("content") or ""), model) for message in messages) + TOKENS_PER_REPLY
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+# On-disk cache of synthesized audio keyed by everything that changes the output, so re-runs only pay for edited segments
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+class TTSCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.total_bytes = sum(path.stat().st_size for path in self._entries())
+
+    @staticmethod
+    def key(text, model, voice, response_format):
+        digest = hashlib.sha256()
+        for part in (model, voice, response_format, text):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path_for(self, key, response_format):
+        return self.cache_dir / key[:2] / f"{key}.{response_format}"
+
+    def _entries(self):
+        return [path for path in self.cache_dir.glob("*/*") if not path.name.endswith(".tmp")]
+
+    def get(self, key, response_format, output_path):
+        # Copies a cached entry to output_path and marks it recently used; False on a miss
+        cached_path = self.path_for(key, response_format)
+        try:
+            shutil.copyfile(cached_path, output_path)
+            os.utime(cached_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, response_format, source_path):
+        cached_path = self.path_for(key, response_format)
+        cached_path.parent.mkdir(exist_ok=True)
+        # Write to a temp name and rename, so a crash or a second story sharing the cache never sees half a file
+        temp_path = cached_path.with_name(f"{cached_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(source_path, temp_path)
+        with self.lock:
+            # Overwriting an entry replaces its bytes rather than adding to them
+            try:
+                old_size = cached_path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(temp_path, cached_path)
+            self.total_bytes += cached_path.stat().st_size - old_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Least recently used first, by mtime, until the cache fits again
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            self.evictions += 1
+        logging.info(f"TTS cache trimmed to {self.total_bytes / 1024 ** 2:.1f} MB")
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return f"TTS cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), {self.evictions} evictions, {self.total_bytes / 1024 ** 2:.1f} MB in {self.cache_dir}"